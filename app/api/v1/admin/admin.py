@@ -3,10 +3,13 @@ from pprint import pprint
 
 from fastapi import APIRouter, Depends, HTTPException
 
-from api.v1.admin.schemas import InstrumentCreateRequest, BalanceChangeScheme
+from api.v1.admin.schemas import InstrumentCreateRequest, BalanceChangeScheme, BalanceBatchScheme, ShardAssignScheme
 from api.v1.auth.jwt import get_current_admin
-from crud.instrument import create_instrument, get_instrument_by_ticker, delete_instrument
-from crud.user import get_user, change_balance, delete_user
+from crud.instrument import create_instrument, get_instrument_by_ticker, delete_instrument, instrument_exists, \
+    get_registered_instruments
+from crud.user import get_user, change_balance, change_balances, delete_user, TOKEN_CACHE
+from crud import shards
+from crud.locks import LOCK_BACKEND, lock_stats
 from database.models import User, Instrument
 from depends import get_instrument_depend, get_user_depend
 
@@ -33,8 +36,7 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
         raise HTTPException(status_code=404, detail="User not found")
 
     if balance_change.ticker != os.getenv('BASE_INSTRUMENT_TICKER'):
-        instrument = await get_instrument_by_ticker(balance_change.ticker)
-        if not instrument:
+        if not await instrument_exists(balance_change.ticker):
             raise HTTPException(status_code=404, detail="Instrument not found")
 
     await change_balance(str(balance_change.user_id), balance_change.ticker, balance_change.amount)
@@ -51,8 +53,7 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
         raise HTTPException(status_code=404, detail="User not found")
 
     if balance_change.ticker != os.getenv('BASE_INSTRUMENT_TICKER'):
-        instrument = await get_instrument_by_ticker(balance_change.ticker)
-        if not instrument:
+        if not await instrument_exists(balance_change.ticker):
             raise HTTPException(status_code=404, detail="Instrument not found")
 
     await change_balance(str(balance_change.user_id), balance_change.ticker, -1 * balance_change.amount)
@@ -63,6 +64,33 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
 
 
 
+@router.post('/balance/deposit/batch')
+async def deposit_batch(changes: BalanceBatchScheme, admin: User = Depends(get_current_admin)):
+    return await balance_batch(changes, 1)
+
+
+@router.post('/balance/withdraw/batch')
+async def withdraw_batch(changes: BalanceBatchScheme, admin: User = Depends(get_current_admin)):
+    return await balance_batch(changes, -1)
+
+
+async def balance_batch(changes: BalanceBatchScheme, sign: int):
+    # Тикеры проверяем по реестру, пользователей и остатки - в crud одним набором
+    result = [None] * len(changes)
+    accepted = []
+    for i, change in enumerate(changes):
+        if change.ticker != os.getenv('BASE_INSTRUMENT_TICKER') and not await instrument_exists(change.ticker):
+            result[i] = {"success": False, "detail": "Instrument not found"}
+            continue
+        accepted.append((i, (change.user_id, change.ticker, sign * change.amount)))
+
+    if accepted:
+        errors = await change_balances([entry for _, entry in accepted])
+        for (i, _), error in zip(accepted, errors):
+            result[i] = {"success": True} if error is None else {"success": False, "detail": error}
+    return result
+
+
 @router.delete('/user/{user_id}')
 async def delete_user_met(user_to_delete: User = Depends(get_user_depend), admin: User = Depends(get_current_admin)):
     deleted = await delete_user(str(user_to_delete.id))
@@ -82,3 +110,41 @@ async def instrument(instrument: Instrument = Depends(get_instrument_depend), us
     return {
         "success": True
     }
+
+
+@router.get('/debug/cache')
+async def cache_stats(user: User = Depends(get_current_admin)):
+    return {
+        "tokens": TOKEN_CACHE.stats()
+    }
+
+
+@router.get('/debug/locks')
+async def locks_stats(top: int = 5, user: User = Depends(get_current_admin)):
+    return {
+        "backend": LOCK_BACKEND,
+        "locks": lock_stats(top)
+    }
+
+
+@router.get('/shards')
+async def shards_info(user: User = Depends(get_current_admin)):
+    return {
+        "shards": shards.MATCHING_SHARDS,
+        "assignment": {ticker: shards.shard_for(ticker) for ticker in await get_registered_instruments()}
+        if shards.MATCHING_SHARDS else {}
+    }
+
+
+@router.post('/shards/assign')
+async def shards_assign(assignment: ShardAssignScheme, user: User = Depends(get_current_admin)):
+    if not shards.is_forwarding():
+        raise HTTPException(400, 'Sharded matching is disabled')
+    if assignment.shard >= shards.MATCHING_SHARDS:
+        raise HTTPException(422, 'No such shard')
+    if not await instrument_exists(assignment.ticker):
+        raise HTTPException(404, 'Instrument not found')
+    await shards.assign(assignment.ticker, assignment.shard)
+    return {
+        "success": True
+    }
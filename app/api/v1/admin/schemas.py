@@ -1,6 +1,6 @@
 from uuid import UUID
 
-from pydantic import BaseModel, constr, field_validator
+from pydantic import BaseModel, constr, conint, conlist, field_validator
 
 
 class InstrumentCreateRequest(BaseModel):
@@ -17,3 +17,11 @@ class BalanceChangeScheme(BaseModel):
         if value <= 0:
             raise ValueError("Amount must be > 0")
         return value
+
+
+BalanceBatchScheme = conlist(BalanceChangeScheme, min_length=1, max_length=10000)
+
+
+class ShardAssignScheme(BaseModel):
+    ticker: constr(pattern="^[A-Z]{2,10}$")
+    shard: conint(ge=0)
@@ -1,8 +1,9 @@
 import asyncio
+import time
 
 import jwt
 from datetime import datetime, timedelta
-from crud.user import get_user, apply_api_key
+from crud.user import get_user, apply_api_key, TOKEN_CACHE, DELETING_USERS
 from fastapi import HTTPException, Depends, Request, status
 import os
 from database.models import User, RoleEnum
@@ -55,6 +56,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "TOKEN"},
     )
+    user = TOKEN_CACHE.get(token)
+    if user is not None:
+        return user
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         id_: str = payload.get("id")
@@ -64,7 +69,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
         raise credentials_exception
 
     user = await get_user(id_)
-    if user:
+    if user and user.id not in DELETING_USERS:
+        # Запись в кэше не должна пережить сам токен
+        TOKEN_CACHE.set(token, user, ttl=payload.get("exp", time.time() + TOKEN_CACHE.ttl) - time.time())
         return user
     raise credentials_exception
 
@@ -1,29 +1,68 @@
+import base64
+import os
 import time
 import uuid
-from datetime import timezone
+from datetime import datetime, timezone
 from pprint import pprint
+from typing import Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 
 from api.v1.auth.jwt import get_current_user
-from api.v1.order.schemas import CreateOrderScheme
-from crud.instrument import get_instrument_by_ticker
+from api.v1.order.schemas import CreateOrderScheme, OrderBatchScheme
+from crud.instrument import instrument_exists
 from crud.order import create_limit_sell_order, create_limit_buy_order, create_market_buy_order, \
-    create_market_sell_order, cancel_order, get_order
+    create_market_sell_order, cancel_order, get_order, create_orders_batch
 from crud.user import get_user_orders
 from database.models import User, OrderStatusEnum, DirectionEnum, Order
 
+# Размер страницы истории ордеров, если задан только cursor, и максимальный
+ORDER_PAGE_SIZE = int(os.getenv('ORDER_PAGE_SIZE', 100))
+ORDER_PAGE_MAX = int(os.getenv('ORDER_PAGE_MAX', 1000))
+
 router = APIRouter()
 
 
-@router.get('')
-async def order(user: User = Depends(get_current_user)):
-    orders = await get_user_orders(str(user.id))
+@router.get('', description='Ордера пользователя от новых к старым. Без limit и cursor - вся история, как раньше; '
+                             'с ними - страница, курсор следующей приходит в заголовке X-Next-Cursor')
+async def order(response: Response, user: User = Depends(get_current_user),
+                limit: Optional[int] = Query(None, ge=1, le=ORDER_PAGE_MAX,
+                                             description=f'Размер страницы, с cursor по умолчанию {ORDER_PAGE_SIZE}'),
+                cursor: Optional[str] = None,
+                status: Optional[OrderStatusEnum] = None,
+                ticker: Optional[str] = None,
+                direction: Optional[str] = Query(None, pattern='^(BUY|SELL)$')):
+    # Страница истории ордеров. Если есть продолжение, его курсор отдаем в заголовке X-Next-Cursor
+    after = decode_cursor(cursor) if cursor else None
+    if direction is not None:
+        direction = DirectionEnum.BID if direction == 'BUY' else DirectionEnum.ASK
+    if limit is None and after is None:
+        # Старые клиенты без параметров получают всю историю, а не первую страницу
+        orders = await get_user_orders(str(user.id), None, None, status, ticker, direction)
+        return [pretty_order(o) for o in orders]
+    limit = limit or ORDER_PAGE_SIZE
+    orders = await get_user_orders(str(user.id), limit + 1, after, status, ticker, direction)
     print('my orders')
+    if len(orders) > limit:
+        orders = orders[:limit]
+        response.headers['X-Next-Cursor'] = encode_cursor(orders[-1])
     res = [pretty_order(o) for o in orders]
     return res
 
 
+def encode_cursor(order: Order) -> str:
+    raw = f'{order.created_at.isoformat()}|{order.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    try:
+        created_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), uuid.UUID(order_id)
+    except ValueError:
+        raise HTTPException(422, detail='bad cursor')
+
+
 @router.delete('/{order_id}')
 async def order(order_id: uuid.UUID, user: User = Depends(get_current_user)):
     order_id = str(order_id)
@@ -75,8 +114,7 @@ async def order(order: CreateOrderScheme, user: User = Depends(get_current_user)
     print('create order')
     pprint(order)
     order_ = None
-    instrument = await get_instrument_by_ticker(order.ticker)
-    if not instrument:
+    if not await instrument_exists(order.ticker):
         raise HTTPException(404, detail='ticker unexist')
     if order.direction == 'BUY':
         order_ = await buy_order(order, user)
@@ -93,6 +131,28 @@ async def order(order: CreateOrderScheme, user: User = Depends(get_current_user)
     }
 
 
+@router.post('/batch')
+async def order_batch(orders: OrderBatchScheme, user: User = Depends(get_current_user)):
+    result = [None] * len(orders)
+    accepted = []
+    for i, order in enumerate(orders):
+        if not await instrument_exists(order.ticker):
+            result[i] = {"success": False, "detail": 'ticker unexist'}
+            continue
+        direction = DirectionEnum.BID if order.direction == 'BUY' else DirectionEnum.ASK
+        accepted.append((i, (direction, order.ticker, order.qty, order.price)))
+
+    if accepted:
+        created = await create_orders_batch([o for _, o in accepted], user)
+        for (i, _), order_ in zip(accepted, created):
+            result[i] = {
+                "success": order_.status != OrderStatusEnum.CANCELLED,
+                "order_id": str(order_.id),
+                "status": order_.status.value
+            }
+    return result
+
+
 async def buy_order(order: CreateOrderScheme, user: User):
     if order.price:
         return await create_limit_buy_order(order.ticker, order.qty, order.price, user)
@@ -1,6 +1,6 @@
 from typing import Optional
 
-from pydantic import BaseModel, constr, conint, field_validator
+from pydantic import BaseModel, constr, conint, conlist, field_validator
 
 
 class CreateOrderScheme(BaseModel):
@@ -14,4 +14,7 @@ class CreateOrderScheme(BaseModel):
         directions = ['BUY', 'SELL']
         if value not in directions:
             raise ValueError(f"Direction must be enum {directions}")
-        return value
\ No newline at end of file
+        return value
+
+
+OrderBatchScheme = conlist(CreateOrderScheme, min_length=1, max_length=1000)
@@ -1,15 +1,22 @@
-from datetime import timezone
+import asyncio
+import json
+from datetime import datetime, timezone
+from typing import Optional
 from pprint import pprint
-from collections import defaultdict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from api.v1.auth.jwt import get_current_user, create_access_token, get_current_admin
 from depends import get_instrument_depend
 from .schemas import UserAuth
 from database.models import User, DirectionEnum, Instrument
 from crud.user import create_user
-from crud.instrument import get_all_instruments, get_instrument_by_ticker, delete_all_instruments
-from crud.order import get_orders, delete_all_orders
+from crud.instrument import get_registered_instruments
+from crud.order import get_orderbook, delete_all_orders
 from crud.transaction import get_transactions_by_ticker
+from crud.candle import INTERVALS, get_candles
+from crud.book import is_resident
+from crud.shards import is_forwarding
+from core.stream import HUB, RESNAPSHOT
 
 router = APIRouter()
 
@@ -32,9 +39,9 @@ async def register(user: UserAuth):
 @router.get('/instrument')
 async def public_test():
     return [{
-        "name": i.name,
-        "ticker": i.ticker
-    } for i in await get_all_instruments()]
+        "name": name,
+        "ticker": ticker
+    } for ticker, name in (await get_registered_instruments()).items()]
 
 
 # @router.get('/orderbook/{ticker}')
@@ -60,26 +67,59 @@ async def public_test():
 
 
 @router.get('/orderbook/{ticker}')
-async def public_test(instrument: Instrument = Depends(get_instrument_depend), limit: int = 10):
+async def public_test(request: Request, response: Response, instrument: Instrument = Depends(get_instrument_depend),
+                      limit: int = 10):
+    tag, depth = await get_orderbook(instrument.ticker, limit)
+    if tag is not None:
+        if request.headers.get('If-None-Match') == tag:
+            return Response(status_code=304, headers={'ETag': tag})
+        response.headers['ETag'] = tag
+    return depth
+
+
+@router.get('/stream/{ticker}')
+async def stream(request: Request, instrument: Instrument = Depends(get_instrument_depend), limit: int = 1000):
+    # Server-Sent Events: снапшот стакана, затем уровни и сделки с возрастающим seq
     ticker = instrument.ticker
+    if is_forwarding() or not is_resident():
+        # События публикуются в процессе, который исполнил ордер (шард или другой воркер), сюда они не доходят.
+        # Без стакана в памяти (MATCHING_ENGINE=sql, в том числе при WORKERS > 1) не из чего считать уровни
+        raise HTTPException(503, 'Stream requires a single matching process with the resident order book')
 
-    async def aggregate_orders(direction: DirectionEnum):
-        orders = await get_orders(ticker, direction, limit=limit)
-        aggregated = defaultdict(int)
-        for order in orders:
-            aggregated[order.price] += order.amount
-        return [{"price": price, "qty": qty} for price, qty in
-                sorted(aggregated.items(), reverse=(direction == DirectionEnum.BID))]
+    async def snapshot():
+        seq = HUB.seq(ticker)
+        tag, depth = await get_orderbook(ticker, limit)
+        if tag is not None:
+            # Стакан в памяти отдается без переключения корутины, поэтому текущий seq ему соответствует
+            seq = HUB.seq(ticker)
+        return {"type": "snapshot", "seq": seq, **depth}
 
-    bid_orders = await aggregate_orders(DirectionEnum.BID)
-    ask_orders = await aggregate_orders(DirectionEnum.ASK)
+    def event(message: dict) -> str:
+        return f"id: {message['seq']}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
 
-    res = {
-        "bid_levels": bid_orders,
-        "ask_levels": ask_orders
-    }
-    pprint(res)
-    return res
+    async def events():
+        subscription = HUB.subscribe(ticker)
+        try:
+            message = await snapshot()
+            last_seq = message["seq"]
+            yield event(message)
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(subscription.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is RESNAPSHOT:
+                    message = await snapshot()
+                elif message["seq"] <= last_seq:
+                    continue
+                last_seq = message["seq"]
+                yield event(message)
+        finally:
+            HUB.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @router.get('/transactions/{ticker}')
@@ -96,3 +136,27 @@ async def public_test(instrument: Instrument = Depends(get_instrument_depend), l
         for t in transactions
     ]
     return transactions
+
+
+@router.get('/candles/{ticker}')
+async def candles(instrument: Instrument = Depends(get_instrument_depend), interval: str = '1m',
+                  start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  limit: int = Query(500, ge=1, le=5000)):
+    # OHLCV из таблицы свечей, сырые сделки не читаем. start/end в UTC
+    if interval not in INTERVALS:
+        raise HTTPException(422, detail=f'interval must be one of {list(INTERVALS)}')
+    if start is not None and start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    if end is not None and end.tzinfo is not None:
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    return [
+        {
+            "timestamp": c.start.replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            "open": c.open,
+            "high": c.high,
+            "low": c.low,
+            "close": c.close,
+            "volume": c.volume
+        }
+        for c in await get_candles(instrument.ticker, interval, start, end, limit)
+    ]
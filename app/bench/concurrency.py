@@ -0,0 +1,178 @@
+# Нагрузочная проверка локов между процессами: несколько процессов одновременно торгуют одним тикером
+# и снимают ордера (одну и ту же заявку сразу несколькими отменами), после чего проверяем,
+# что ни деньги, ни инструменты не появились и не пропали.
+# Запуск из папки app против локальной базы: python -m bench.concurrency --processes 4 --orders 300
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+os.environ['LOCK_BACKEND'] = 'postgres'
+os.environ['MATCHING_ENGINE'] = 'sql'
+
+TICKER = 'CONCUR'
+START_RUB = 10 ** 6
+START_QTY = 10 ** 4
+
+
+def worker(user_ids, orders: int, seed: int):
+    from fastapi import HTTPException
+    from sqlalchemy import select
+    from crud.order import create_limit_buy_order, create_limit_sell_order, create_market_buy_order, \
+        create_market_sell_order, cancel_order
+    from crud.user import get_user
+    from database.database import async_session_maker
+    from database.models import Order, OrderStatusEnum
+
+    rnd = random.Random(seed)
+
+    async def cancel(order_id: str, user_id):
+        try:
+            await cancel_order(order_id, user_id)
+        except HTTPException:
+            # Ордер успели исполнить или снять - это нормальный исход гонки
+            pass
+
+    async def cancel_random():
+        # Любой открытый ордер тикера, в том числе чужого процесса, и сразу две отмены на него
+        async with async_session_maker() as session:
+            q = select(Order.id, Order.user_id).where(
+                Order.instrument_ticker == TICKER, Order.status == OrderStatusEnum.NEW, Order.price.isnot(None)
+            ).limit(20)
+            rows = (await session.execute(q)).all()
+        if rows:
+            order_id, user_id = rnd.choice(rows)
+            await asyncio.gather(cancel(str(order_id), user_id), cancel(str(order_id), user_id))
+
+    async def run():
+        users = [await get_user(u) for u in user_ids]
+        for _ in range(orders):
+            user = rnd.choice(users)
+            qty = rnd.randint(1, 10)
+            price = rnd.randint(90, 110)
+            kind = rnd.random()
+            if kind < 0.35:
+                await create_limit_buy_order(TICKER, qty, price, user)
+            elif kind < 0.7:
+                await create_limit_sell_order(TICKER, qty, price, user)
+            elif kind < 0.8:
+                await create_market_buy_order(TICKER, qty, user)
+            elif kind < 0.9:
+                await create_market_sell_order(TICKER, qty, user)
+            else:
+                await cancel_random()
+
+    asyncio.run(run())
+
+
+async def setup(users: int):
+    from crud.instrument import create_instrument, get_instrument_by_ticker, delete_instrument
+    from crud.order import RUB
+    from crud.user import create_user, change_balance
+    from database.database import engine
+
+    if await get_instrument_by_ticker(TICKER):
+        await delete_instrument(TICKER)
+    await create_instrument('concurrency check', TICKER)
+    ids = []
+    for i in range(users):
+        user = await create_user(f'concurrency-{i}')
+        await change_balance(user.id, RUB, START_RUB)
+        await change_balance(user.id, TICKER, START_QTY)
+        ids.append(str(user.id))
+    # Следующий asyncio.run будет с другим event loop, соединения этого пула там не годятся
+    await engine.dispose()
+    return ids
+
+
+async def check(user_ids):
+    from sqlalchemy import select
+    from crud.instrument import delete_instrument
+    from crud.user import get_user, delete_user
+    from database.database import async_session_maker
+    from database.models import Order, UserInventory, OrderStatusEnum, DirectionEnum
+
+    rub, qty = 0, 0
+    frozen_rub, frozen_qty = 0, 0
+    problems = []
+    async with async_session_maker() as session:
+        for user_id in user_ids:
+            user = await get_user(user_id)
+            inv = (await session.execute(select(UserInventory).where(
+                UserInventory.user_id == user.id, UserInventory.instrument_ticker == TICKER))).scalars().first()
+            if user.balance < 0 or inv.quantity < 0:
+                problems.append(f'negative balance for {user_id}')
+            rub += user.balance
+            qty += inv.quantity
+            frozen_rub += user.frozen_balance
+            frozen_qty += inv.frozen
+        q = select(Order).where(Order.instrument_ticker == TICKER,
+                                Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]))
+        for order in (await session.execute(q)).scalars():
+            if order.direction == DirectionEnum.BID:
+                rub += order.amount * order.price
+                frozen_rub -= order.amount * order.price
+            else:
+                qty += order.amount
+                frozen_qty -= order.amount
+
+    # Замороженное в пользователях должно совпадать с тем, что держат открытые ордера
+    if frozen_rub != 0 or frozen_qty != 0:
+        problems.append(f'frozen ledger is off by {frozen_rub} RUB, {frozen_qty} {TICKER}')
+
+    if rub != START_RUB * len(user_ids):
+        problems.append(f'RUB total {rub} != {START_RUB * len(user_ids)}')
+    if qty != START_QTY * len(user_ids):
+        problems.append(f'{TICKER} total {qty} != {START_QTY * len(user_ids)}')
+
+    # Удаление тикера снимает его открытые ордера: рубли под заявками на покупку должны вернуться в баланс
+    await delete_instrument(TICKER)
+    rub, frozen_rub = 0, 0
+    for user_id in user_ids:
+        user = await get_user(user_id)
+        rub += user.balance
+        frozen_rub += user.frozen_balance
+    if frozen_rub != 0:
+        problems.append(f'{frozen_rub} RUB stays frozen after deleting {TICKER}')
+    if rub != START_RUB * len(user_ids):
+        problems.append(f'RUB total after deleting {TICKER}: {rub} != {START_RUB * len(user_ids)}')
+
+    for user_id in user_ids:
+        await delete_user(user_id)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--orders', type=int, default=300)
+    parser.add_argument('--users', type=int, default=6)
+    args = parser.parse_args()
+
+    user_ids = asyncio.run(setup(args.users))
+    ctx = multiprocessing.get_context('spawn')
+    processes = [ctx.Process(target=worker, args=(user_ids, args.orders, seed)) for seed in range(args.processes)]
+    started = time.perf_counter()
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - started
+    print(f'{args.processes * args.orders} orders from {args.processes} processes in {elapsed:.2f}s')
+
+    problems = asyncio.run(check(user_ids))
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print('balances are consistent')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Задержка ордеров по тикеру, который не связан с удаляемыми пользователями:
+# сначала без удалений, потом параллельно с пакетным удалением пользователей.
+# Запуск из папки app против локальной базы: python -m bench.delete_users --users 50 --orders 300
+import argparse
+import asyncio
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from crud.instrument import create_instrument, delete_instrument, get_instrument_by_ticker
+from crud.order import create_limit_buy_order, create_limit_sell_order, RUB
+from crud.user import create_user, change_balance, delete_user
+
+HOT = 'DELHOT'
+COLD = 'DELCOLD'
+
+
+async def trader(user, orders: int) -> list:
+    latencies = []
+    for i in range(orders):
+        started = time.perf_counter()
+        if i % 2:
+            await create_limit_buy_order(HOT, 1, 100, user)
+        else:
+            await create_limit_sell_order(HOT, 1, 100, user)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def victims(count: int) -> list:
+    users = []
+    for i in range(count):
+        user = await create_user(f'victim-{i}')
+        await change_balance(user.id, RUB, 10 ** 6)
+        await change_balance(user.id, COLD, 10 ** 4)
+        for price in range(90, 100):
+            await create_limit_buy_order(COLD, 1, price, user)
+            await create_limit_sell_order(COLD, 1, price + 20, user)
+        users.append(user)
+    return users
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f'{name:>16}: p50 {statistics.median(latencies) * 1000:7.2f} ms, p99 {p99 * 1000:7.2f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--orders', type=int, default=300)
+    args = parser.parse_args()
+
+    for ticker in (HOT, COLD):
+        if await get_instrument_by_ticker(ticker):
+            await delete_instrument(ticker)
+        await create_instrument(ticker, ticker)
+    user = await create_user('hot-trader')
+    await change_balance(user.id, RUB, 10 ** 9)
+    await change_balance(user.id, HOT, 10 ** 6)
+
+    report('no deletions', await trader(user, args.orders))
+
+    users = await victims(args.users)
+
+    async def delete_all():
+        for u in users:
+            await delete_user(str(u.id))
+
+    latencies, _ = await asyncio.gather(trader(user, args.orders), delete_all())
+    report('with deletions', latencies)
+
+    await delete_user(str(user.id))
+    for ticker in (HOT, COLD):
+        await delete_instrument(ticker)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
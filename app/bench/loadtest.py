@@ -0,0 +1,272 @@
+# Нагрузочный прогон через HTTP API против запущенного сервиса с локальной базой.
+# Заводит тикеры и пользователей через API, пополняет их пакетным депозитом и гоняет смесь
+# лимитных, рыночных ордеров, отмен и чтений стакана. Итог - JSON с пропускной способностью
+# и p50/p95/p99 по каждому эндпоинту; с --baseline сравнивает p95 с прошлым прогоном.
+# Запуск из папки app: python -m bench.loadtest --admin-key $ADMIN_KEY --tickers 4 --users 50 --duration 30
+# Внимание: /public/register очищает все ордера биржи, так что не запускать против живого сервиса
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+RUB = os.getenv('BASE_INSTRUMENT_TICKER', 'RUB')
+
+
+class HttpClient:
+    # Минимальный HTTP/1.1 клиент с keep-alive: из зависимостей проекта HTTP-клиента нет
+    def __init__(self, url: str, token: Optional[str] = None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.token = token
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body=None) -> Tuple[int, object]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body).encode() if body is not None else b''
+        headers = [f'{method} {path} HTTP/1.1', f'Host: {self.host}', f'Content-Length: {len(payload)}']
+        if body is not None:
+            headers.append('Content-Type: application/json')
+        if self.token:
+            headers.append(f'Authorization: TOKEN {self.token}')
+        try:
+            self.writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + payload)
+            await self.writer.drain()
+            return await self.__response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            raise
+
+    async def __response(self) -> Tuple[int, object]:
+        status = int((await self.reader.readline()).split()[1])
+        headers = dict()
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            await self.close()
+        return status, json.loads(data) if data else None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = None, None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        self.statuses: Dict[str, Dict[str, int]] = dict()
+
+    async def call(self, name: str, client: HttpClient, method: str, path: str, body=None) -> Tuple[int, object]:
+        started = time.perf_counter()
+        try:
+            status, data = await client.request(method, path, body)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            status, data = 0, None
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        counts = self.statuses.setdefault(name, dict())
+        counts[str(status)] = counts.get(str(status), 0) + 1
+        return status, data
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Ближайший ранг по отсортированному списку
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def tickers_for(count: int, seed: int) -> List[str]:
+    rnd = random.Random(seed)
+    suffix = ''.join(rnd.choice(string.ascii_uppercase) for _ in range(4))
+    return [f'LT{suffix}{string.ascii_uppercase[i // 26]}{string.ascii_uppercase[i % 26]}' for i in range(count)]
+
+
+async def setup(args, admin: HttpClient) -> Tuple[List[str], List[dict]]:
+    tickers = tickers_for(args.tickers, args.seed)
+    for ticker in tickers:
+        status, data = await admin.request('POST', '/api/v1/admin/instrument', {'name': ticker, 'ticker': ticker})
+        if status != 200:
+            raise SystemExit(f'cannot create {ticker}: {status} {data}')
+    client = HttpClient(args.url)
+    users = []
+    for i in range(args.users):
+        status, data = await client.request('POST', '/api/v1/public/register', {'name': f'load-{args.seed}-{i}'})
+        if status != 200:
+            raise SystemExit(f'cannot register user: {status} {data}')
+        users.append(data)
+    await client.close()
+
+    deposits = [{'user_id': u['id'], 'ticker': RUB, 'amount': args.cash} for u in users]
+    deposits += [{'user_id': u['id'], 'ticker': t, 'amount': args.quantity} for u in users for t in tickers]
+    for i in range(0, len(deposits), 10000):
+        status, data = await admin.request('POST', '/api/v1/admin/balance/deposit/batch', deposits[i:i + 10000])
+        if status != 200 or not all(r['success'] for r in data):
+            raise SystemExit(f'deposit failed: {status}')
+    return tickers, users
+
+
+async def worker(n: int, args, tickers: List[str], users: List[dict], mix: List[Tuple[str, int]],
+                 recorder: Recorder, deadline: float, counter: List[int]):
+    # Последовательность действий определяется seed и номером воркера
+    rnd = random.Random(args.seed * 1000 + n)
+    user = users[n % len(users)]
+    client = HttpClient(args.url, user['api_key'])
+    names, weights = zip(*mix)
+    open_orders: List[str] = []
+    while time.perf_counter() < deadline and (not args.requests or counter[0] < args.requests):
+        counter[0] += 1
+        action = rnd.choices(names, weights)[0]
+        ticker = rnd.choice(tickers)
+        direction = rnd.choice(['BUY', 'SELL'])
+        if action == 'limit':
+            price = rnd.randint(args.price - args.spread, args.price + args.spread)
+            body = {'direction': direction, 'ticker': ticker, 'qty': rnd.randint(1, 10), 'price': price}
+            status, data = await recorder.call('POST /order limit', client, 'POST', '/api/v1/order', body)
+            if status == 200 and data.get('success'):
+                open_orders.append(data['order_id'])
+        elif action == 'market':
+            body = {'direction': direction, 'ticker': ticker, 'qty': rnd.randint(1, 5)}
+            await recorder.call('POST /order market', client, 'POST', '/api/v1/order', body)
+        elif action == 'cancel' and open_orders:
+            order_id = open_orders.pop(rnd.randrange(len(open_orders)))
+            await recorder.call('DELETE /order/{id}', client, 'DELETE', f'/api/v1/order/{order_id}')
+        elif action == 'book':
+            await recorder.call('GET /public/orderbook', client, 'GET', f'/api/v1/public/orderbook/{ticker}?limit=10')
+    await client.close()
+
+
+async def teardown(admin: HttpClient, tickers: List[str], users: List[dict]):
+    for user in users:
+        await admin.request('DELETE', f'/api/v1/admin/user/{user["id"]}')
+    for ticker in tickers:
+        await admin.request('DELETE', f'/api/v1/admin/instrument/{ticker}')
+
+
+def report(args, recorder: Recorder, elapsed: float) -> dict:
+    endpoints = dict()
+    for name, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        endpoints[name] = {
+            'count': len(values),
+            'rps': len(values) / elapsed,
+            'statuses': recorder.statuses[name],
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+    total = sum(e['count'] for e in endpoints.values())
+    return {
+        'revision': revision,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - elapsed)),
+        'config': {k: v for k, v in vars(args).items() if k not in ('admin_key', 'out', 'baseline')},
+        'elapsed_s': elapsed,
+        'requests': total,
+        'rps': total / elapsed,
+        'endpoints': endpoints,
+    }
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    for name, current in result['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            found.append(f'{name}: p95 {current["p95_ms"]:.2f}ms vs {previous["p95_ms"]:.2f}ms')
+    if result['rps'] < baseline.get('rps', 0) * (1 - tolerance):
+        found.append(f'throughput {result["rps"]:.1f} rps vs {baseline["rps"]:.1f} rps')
+    return found
+
+
+def parse_mix(value: str) -> List[Tuple[str, int]]:
+    mix = [(name, int(weight)) for name, weight in (item.split('=') for item in value.split(','))]
+    unknown = {name for name, _ in mix} - {'limit', 'market', 'cancel', 'book'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown actions {unknown}')
+    return mix
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--admin-key', default=os.getenv('ADMIN_API_KEY'), help='api_key администратора')
+    parser.add_argument('--tickers', type=int, default=4)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help='секунд нагрузки')
+    parser.add_argument('--requests', type=int, default=0, help='остановиться после N запросов (0 - по времени)')
+    parser.add_argument('--mix', type=parse_mix, default='limit=50,market=10,cancel=20,book=20')
+    parser.add_argument('--price', type=int, default=100)
+    parser.add_argument('--spread', type=int, default=5)
+    parser.add_argument('--cash', type=int, default=10 ** 9)
+    parser.add_argument('--quantity', type=int, default=10 ** 6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help='куда записать JSON (по умолчанию loadtest-<время>.json)')
+    parser.add_argument('--baseline', default=None, help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение p95 и rps')
+    parser.add_argument('--keep', action='store_true', help='не удалять пользователей и тикеры после прогона')
+    args = parser.parse_args()
+    if not args.admin_key:
+        raise SystemExit('--admin-key or ADMIN_API_KEY is required')
+
+    admin = HttpClient(args.url, args.admin_key)
+    tickers, users = await setup(args, admin)
+    recorder = Recorder()
+    counter = [0]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*[
+        worker(n, args, tickers, users, args.mix, recorder, deadline, counter) for n in range(args.concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+    if not args.keep:
+        await teardown(admin, tickers, users)
+    await admin.close()
+
+    result = report(args, recorder, elapsed)
+    out = args.out or time.strftime('loadtest-%Y%m%d-%H%M%S.json')
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'{result["requests"]} requests in {elapsed:.1f}s, {result["rps"]:.1f} rps -> {out}')
+    for name, e in result['endpoints'].items():
+        print(f'{name:>24}: {e["count"]:7d} p50 {e["p50_ms"]:7.2f}ms p95 {e["p95_ms"]:7.2f}ms '
+              f'p99 {e["p99_ms"]:7.2f}ms {e["statuses"]}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION', line)
+        if found:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+# Сравнение пропускной способности матчинга: стакан из Postgres (sql) против стакана в памяти (memory).
+# Запуск из папки app против локальной базы: python -m bench.matching --orders 2000
+import argparse
+import asyncio
+import random
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+import crud.book
+from crud.instrument import create_instrument, delete_instrument
+from crud.order import create_limit_buy_order, create_limit_sell_order, RUB
+from crud.user import create_user, change_balance, delete_user
+from database.database import async_session_maker
+from database.models import Transaction
+from sqlalchemy import select
+
+
+def make_flow(orders: int, users: int, seed: int):
+    rnd = random.Random(seed)
+    flow = []
+    for _ in range(orders):
+        side = rnd.choice(['BUY', 'SELL'])
+        price = rnd.randint(95, 105)
+        flow.append((side, rnd.randrange(users), rnd.randint(1, 20), price))
+    return flow
+
+
+async def run(engine: str, flow, users: int, ticker: str):
+    crud.book.MATCHING_ENGINE = engine
+    crud.book.drop_all_books()
+    await create_instrument(f'bench {engine}', ticker)
+    accounts = []
+    for i in range(users):
+        user = await create_user(f'bench-{engine}-{i}')
+        await change_balance(user.id, RUB, 10 ** 9)
+        await change_balance(user.id, ticker, 10 ** 7)
+        accounts.append(user)
+
+    started = time.perf_counter()
+    for side, user_idx, qty, price in flow:
+        if side == 'BUY':
+            await create_limit_buy_order(ticker, qty, price, accounts[user_idx])
+        else:
+            await create_limit_sell_order(ticker, qty, price, accounts[user_idx])
+    elapsed = time.perf_counter() - started
+
+    index = {u.id: i for i, u in enumerate(accounts)}
+    async with async_session_maker() as session:
+        q = select(Transaction).where(Transaction.instrument_ticker == ticker).order_by(Transaction.timestamp)
+        tape = [(index[t.user_from_id], index[t.user_to_id], t.amount, t.price)
+                for t in (await session.execute(q)).scalars()]
+
+    await delete_instrument(ticker)
+    for user in accounts:
+        await delete_user(str(user.id))
+    return elapsed, tape
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    flow = make_flow(args.orders, args.users, args.seed)
+    results = dict()
+    for engine, ticker in (('sql', 'BENCHSQL'), ('memory', 'BENCHMEM')):
+        elapsed, tape = await run(engine, flow, args.users, ticker)
+        results[engine] = tape
+        print(f'{engine:>6}: {args.orders / elapsed:10.1f} orders/sec, {len(tape)} fills, {elapsed:.2f}s')
+
+    if results['sql'] != results['memory']:
+        raise SystemExit('fills differ between sql and memory engines')
+    print('fills are identical')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
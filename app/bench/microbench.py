@@ -0,0 +1,196 @@
+# Микробенчмарки функций матчинга без HTTP: время и число SQL-запросов на операцию
+# в зависимости от глубины стакана и числа сделок на ордер.
+# Стакан засевается напрямую в одноразовую базу, чтобы глубина была любой.
+# Запуск из папки app: python -m bench.microbench --depths 10,100,1000,10000 --fills 0,1,5,20 --engine memory
+import argparse
+import asyncio
+import json
+import math
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import event, insert, select, update
+
+import crud.book
+from crud.book import drop_book
+from crud.instrument import create_instrument, delete_instrument
+from crud.order import create_limit_buy_order, create_limit_sell_order, cancel_order, get_orderbook, \
+    buy, sell, freeze_balance, RUB
+from crud.user import create_user, change_balance, delete_user
+from database.database import engine, async_session_maker
+from database.models import Order, User, UserInventory, DirectionEnum, OrderStatusEnum
+
+# Лучшая цена засеянного стакана, с запасом, чтобы глубокие уровни заявок на покупку оставались > 0
+TOP = 10 ** 6
+
+
+@contextmanager
+def count_statements():
+    counter = [0]
+
+    def listener(*args):
+        counter[0] += 1
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', listener)
+    try:
+        yield counter
+    finally:
+        event.remove(engine.sync_engine, 'before_cursor_execute', listener)
+
+
+async def seed_book(ticker: str, maker: User, side: DirectionEnum, orders: int, per_level: int):
+    # Ордера по 1 штуке, per_level на уровень, лучшая цена - TOP. Замороженное мейкера сходится с ордерами
+    start = datetime.utcnow() - timedelta(days=1)
+    rows, frozen = [], 0
+    for i in range(orders):
+        price = TOP + i // per_level if side == DirectionEnum.ASK else TOP - i // per_level
+        frozen += 1 if side == DirectionEnum.ASK else price
+        rows.append({
+            'id': uuid.uuid4(), 'user_id': maker.id, 'instrument_ticker': ticker, 'amount': 1, 'filled': 0,
+            'price': price, 'direction': side, 'status': OrderStatusEnum.NEW,
+            'created_at': start + timedelta(microseconds=i)
+        })
+    async with engine.begin() as conn:
+        for i in range(0, len(rows), 10000):
+            await conn.execute(insert(Order), rows[i:i + 10000])
+        if side == DirectionEnum.ASK:
+            await conn.execute(update(UserInventory).where(
+                UserInventory.user_id == maker.id, UserInventory.instrument_ticker == ticker
+            ).values(frozen=UserInventory.frozen + frozen))
+        else:
+            await conn.execute(update(User).where(User.id == maker.id)
+                               .values(frozen_balance=User.frozen_balance + frozen))
+    # Стакан в памяти перечитается из базы, загрузку в замер не включаем
+    drop_book(ticker)
+    await get_orderbook(ticker)
+
+
+async def measure(calls) -> dict:
+    with count_statements() as counter:
+        started = time.perf_counter()
+        for call in calls:
+            await call()
+        elapsed = time.perf_counter() - started
+    return {'us_per_op': elapsed / len(calls) * 10 ** 6, 'statements_per_op': counter[0] / len(calls)}
+
+
+async def bench_orders(depth: int, fills: int, side: DirectionEnum, repeat: int, per_level: int, n: int) -> dict:
+    ticker = f'MB{chr(65 + n // 26 % 26)}{chr(65 + n % 26)}'
+    await create_instrument(ticker, ticker)
+    maker, taker = await create_user('bench-maker'), await create_user('bench-taker')
+    for user in (maker, taker):
+        await change_balance(user.id, RUB, 10 ** 12)
+        await change_balance(user.id, ticker, 10 ** 9)
+    # Каждый повтор снимает fills ордеров, поэтому засеваем с запасом: глубина держится около depth
+    await seed_book(ticker, maker, side, depth + repeat * fills, per_level)
+
+    # cross пробивает весь стакан, rest встает в стакан, ничего не исполнив
+    if side == DirectionEnum.ASK:
+        create, cross, rest = create_limit_buy_order, 2 * TOP, 1
+    else:
+        create, cross, rest = create_limit_sell_order, 1, 2 * TOP
+    name = create.__name__
+    if fills:
+        result = await measure([lambda: create(ticker, fills, cross, taker) for _ in range(repeat)])
+    else:
+        result = await measure([lambda: create(ticker, 1, rest, taker) for _ in range(repeat)])
+    results = {name: result}
+
+    # Отмена ордеров, стоящих на глубине depth
+    resting = [await create(ticker, 1, rest, taker) for _ in range(repeat)]
+    results['cancel_order'] = await measure([
+        (lambda order_id=o.id: cancel_order(str(order_id), taker.id)) for o in resting
+    ])
+
+    await delete_instrument(ticker)
+    await delete_user(str(maker.id))
+    await delete_user(str(taker.id))
+    return results
+
+
+async def bench_settlement(repeat: int) -> dict:
+    # buy/sell - расчет одной сделки над уже загруженными объектами, freeze_balance - с походом в базу
+    ticker = 'MBSETTLE'
+    await create_instrument(ticker, ticker)
+    a, b = await create_user('bench-a'), await create_user('bench-b')
+    for user in (a, b):
+        await change_balance(user.id, RUB, 10 ** 12)
+        await change_balance(user.id, ticker, 10 ** 9)
+    results = dict()
+    async with async_session_maker() as session:
+        seller, buyer = await session.get(User, a.id), await session.get(User, b.id)
+        seller_inv, buyer_inv = [(await session.execute(select(UserInventory).where(
+            UserInventory.user_id == u.id, UserInventory.instrument_ticker == ticker))).scalars().one() for u in (a, b)]
+
+        async def one_buy():
+            buy(seller, buyer, seller_inv, buyer_inv, ticker, 100, 1)
+
+        async def one_sell():
+            sell(seller, buyer, seller_inv, buyer_inv, ticker, 100, 1)
+
+        results['buy'] = await measure([one_buy] * repeat)
+        results['sell'] = await measure([one_sell] * repeat)
+        results['freeze_balance'] = await measure([lambda: freeze_balance(session, a.id, ticker, 1)] * repeat)
+        await session.rollback()
+
+    await delete_instrument(ticker)
+    await delete_user(str(a.id))
+    await delete_user(str(b.id))
+    return results
+
+
+def slopes(rows: list) -> None:
+    # Наклон в логарифмах между соседними глубинами: ~0 - не зависит от глубины, ~1 - линейно
+    previous = dict()
+    for row in rows:
+        key = (row['function'], row['side'], row['fills'])
+        prev = previous.get(key)
+        row['slope'] = None
+        if prev is not None and row['depth'] != prev['depth'] and prev['us_per_op'] > 0:
+            row['slope'] = math.log(row['us_per_op'] / prev['us_per_op']) / math.log(row['depth'] / prev['depth'])
+        previous[key] = row
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', default='10,100,1000,10000')
+    parser.add_argument('--fills', default='0,1,5,20')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--per-level', type=int, default=10, help='ордеров на ценовом уровне')
+    parser.add_argument('--engine', choices=['sql', 'memory'], default=crud.book.MATCHING_ENGINE)
+    parser.add_argument('--out', default=None, help='записать результаты в JSON')
+    args = parser.parse_args()
+    crud.book.MATCHING_ENGINE = args.engine
+
+    rows, n = [], 0
+    for side in (DirectionEnum.ASK, DirectionEnum.BID):
+        for depth in [int(d) for d in args.depths.split(',')]:
+            for fills in [int(f) for f in args.fills.split(',')]:
+                for function, result in (await bench_orders(depth, fills, side, args.repeat, args.per_level, n)).items():
+                    rows.append({'function': function, 'side': side.name, 'depth': depth, 'fills': fills, **result})
+                n += 1
+    for function, result in (await bench_settlement(args.repeat * 10)).items():
+        rows.append({'function': function, 'side': None, 'depth': None, 'fills': None, **result})
+    slopes([r for r in rows if r['depth'] is not None])
+    await engine.dispose()
+
+    print(f'engine={args.engine}')
+    print(f'{"function":>24} {"book":>4} {"depth":>7} {"fills":>5} {"us/op":>10} {"stmts/op":>9} {"slope":>6}')
+    for r in rows:
+        slope = f'{r["slope"]:6.2f}' if r.get('slope') is not None else ''
+        print(f'{r["function"]:>24} {r["side"] or "-":>4} {r["depth"] if r["depth"] is not None else "-":>7} '
+              f'{r["fills"] if r["fills"] is not None else "-":>5} {r["us_per_op"]:10.1f} '
+              f'{r["statements_per_op"]:9.1f} {slope:>6}')
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'engine': args.engine, 'rows': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# Сравнение расчетов по сделкам: ORM unit of work (orm) против set-based запросов (core).
+# Один и тот же поток ордеров прогоняется в обоих режимах, лента сделок и итоговые балансы должны совпасть.
+# Запуск из папки app против локальной базы: python -m bench.settlement --orders 2000 --sweep 20
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import event, select
+
+import crud.settlement
+from bench.matching import make_flow
+from crud.instrument import create_instrument, delete_instrument
+from crud.order import create_limit_buy_order, create_limit_sell_order, RUB
+from crud.user import create_user, change_balance, delete_user
+from database.database import async_session_maker, engine
+from database.models import Transaction, User, UserInventory
+
+
+async def run(mode: str, flow, users: int, sweep: int, ticker: str):
+    crud.settlement.SETTLEMENT = mode
+    await create_instrument(f'bench {mode}', ticker)
+    accounts = []
+    for i in range(users):
+        user = await create_user(f'bench-{mode}-{i}')
+        await change_balance(user.id, RUB, 10 ** 9)
+        await change_balance(user.id, ticker, 10 ** 7)
+        accounts.append(user)
+
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', count)
+    started = time.perf_counter()
+    for n, (side, user_idx, qty, price) in enumerate(flow):
+        # Каждый sweep-й ордер - крупный и по рынку, он снимает много встречных
+        if sweep and n % sweep == sweep - 1:
+            qty, price = qty * sweep, None
+        if side == 'BUY':
+            await create_limit_buy_order(ticker, qty, price, accounts[user_idx])
+        else:
+            await create_limit_sell_order(ticker, qty, price, accounts[user_idx])
+    elapsed = time.perf_counter() - started
+    event.remove(engine.sync_engine, 'before_cursor_execute', count)
+
+    index = {u.id: i for i, u in enumerate(accounts)}
+    async with async_session_maker() as session:
+        q = select(Transaction).where(Transaction.instrument_ticker == ticker).order_by(Transaction.timestamp)
+        tape = [(index[t.user_from_id], index[t.user_to_id], t.amount, t.price)
+                for t in (await session.execute(q)).scalars()]
+        q = select(User.id, User.balance, User.frozen_balance, UserInventory.quantity, UserInventory.frozen) \
+            .join(UserInventory, UserInventory.user_id == User.id) \
+            .where(User.id.in_(index), UserInventory.instrument_ticker == ticker)
+        balances = sorted((index[user_id], *rest) for user_id, *rest in (await session.execute(q)).all())
+
+    await delete_instrument(ticker)
+    for user in accounts:
+        await delete_user(str(user.id))
+    return elapsed, statements, tape, balances
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--sweep', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    flow = make_flow(args.orders, args.users, args.seed)
+    results = dict()
+    for mode, ticker in (('orm', 'BENCHORM'), ('core', 'BENCHCORE')):
+        elapsed, statements, tape, balances = await run(mode, flow, args.users, args.sweep, ticker)
+        results[mode] = (tape, balances)
+        print(f'{mode:>4}: {args.orders / elapsed:10.1f} orders/sec, {len(tape)} fills, '
+              f'{statements / args.orders:.1f} statements/order, {elapsed:.2f}s')
+
+    if results['orm'][0] != results['core'][0]:
+        raise SystemExit('fills differ between orm and core settlement')
+    if results['orm'][1] != results['core'][1]:
+        raise SystemExit('balances differ between orm and core settlement')
+    print('fills and balances are identical')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
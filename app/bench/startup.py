@@ -0,0 +1,72 @@
+# Время подъема стаканов при старте: заливаем открытые ордера через COPY и грузим их так же, как lifespan.
+# Загрузка линейна по числу ордеров, поэтому результат пересчитываем на 10M и сравниваем с BOOK_LOAD_BUDGET.
+# Запуск из папки app против локальной базы: python -m bench.startup --orders 1000000 --tickers 10
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+import crud.book
+from crud.book import BOOK_LOAD_BUDGET, BOOKS, load_books
+from crud.instrument import create_instrument, delete_instrument
+from crud.user import create_user, delete_user
+from database.database import engine
+
+
+async def seed(tickers, orders: int, user_id: uuid.UUID):
+    # Аски выше 1000, биды ниже: стакан не пересекается, как после нормальной торговли
+    started = datetime.utcnow() - timedelta(days=1)
+    records = []
+    for n in range(orders):
+        ask = n % 2 == 0
+        price = random.randint(1001, 1500) if ask else random.randint(500, 999)
+        records.append((uuid.uuid4(), user_id, tickers[n % len(tickers)], random.randint(1, 100), 0, price,
+                        'ASK' if ask else 'BID', 'NEW', started + timedelta(microseconds=n)))
+    async with engine.connect() as conn:
+        raw = (await conn.get_raw_connection()).driver_connection
+        await raw.copy_records_to_table(
+            'orders', records=records,
+            columns=['id', 'user_id', 'instrument_ticker', 'amount', 'filled', 'price', 'direction', 'status',
+                     'created_at'])
+        await raw.execute('ANALYZE orders')
+
+
+async def main(orders: int, tickers: int, concurrency: int):
+    names = [f'BOOT{i}' for i in range(tickers)]
+    for ticker in names:
+        await create_instrument(f'bench {ticker}', ticker)
+    user = await create_user('bench-startup')
+    try:
+        started = time.perf_counter()
+        await seed(names, orders, user.id)
+        print(f'seeded {orders} open orders in {time.perf_counter() - started:.1f}s')
+
+        for ticker in names:
+            BOOKS.pop(ticker, None)
+        crud.book.BOOK_LOAD_CONCURRENCY = concurrency
+        stats = await load_books(names)
+        assert stats['orders'] == orders, stats
+        projected = stats['seconds'] * 10 ** 7 / orders
+        print(f'loaded {stats["orders"]} orders of {stats["tickers"]} tickers in {stats["seconds"]}s '
+              f'({stats["orders_per_second"]} orders/s, concurrency {concurrency})')
+        print(f'10M open orders: ~{projected:.0f}s, budget {BOOK_LOAD_BUDGET:.0f}s '
+              f'-> {"ok" if projected <= BOOK_LOAD_BUDGET else "OVER BUDGET"}')
+    finally:
+        for ticker in names:
+            await delete_instrument(ticker)
+        await delete_user(str(user.id))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--tickers', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=crud.book.BOOK_LOAD_CONCURRENCY)
+    args = parser.parse_args()
+    asyncio.run(main(args.orders, args.tickers, args.concurrency))
@@ -0,0 +1,58 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    # LRU-кэш с ограничением по размеру и временем жизни записей
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__data: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self.__data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self.__data[key]
+            self.misses += 1
+            return None
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self.__data[key] = (value, time.monotonic() + ttl)
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self.__data.pop(key, None)
+
+    def invalidate(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key, (value, _) in self.__data.items() if predicate(value)]
+        for key in keys:
+            del self.__data[key]
+        return len(keys)
+
+    def clear(self):
+        self.__data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.__data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,77 @@
+import json
+import os
+import time
+from typing import Optional
+
+# NDJSON-журнал команд, меняющих состояние биржи: ордера, отмены, пополнения, заведение пользователей и тикеров.
+# Пустой JOURNAL_PATH - журнал выключен. Пишет тот процесс, который исполняет команды, поэтому
+# для воспроизводимого журнала нужен один процесс матчинга (WORKERS=1, MATCHING_SHARDS=0), main.py это проверяет
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', '')
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        self.seq = 0
+        self.__file = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def __open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            # Продолжаем нумерацию с последней целой строки, читаем только хвост файла
+            size = os.path.getsize(self.path)
+            with open(self.path, 'r+b') as f:
+                start = max(0, size - 65536)
+                f.seek(start)
+                tail = f.read()
+                if not tail.endswith(b'\n'):
+                    # Процесс упал посреди записи: недописанную строку отрезаем
+                    cut = tail.rfind(b'\n') + 1
+                    print(f'journal {self.path}: dropping torn entry {tail[cut:][:200]!r}')
+                    f.truncate(start + cut)
+                    tail = tail[:cut]
+            for line in reversed(tail.splitlines()):
+                try:
+                    self.seq = json.loads(line)['seq']
+                    break
+                except (ValueError, KeyError):
+                    continue
+        # Построчная буферизация: каждая запись уходит в файл целиком сразу после команды
+        self.__file = open(self.path, 'a', buffering=1)
+
+    def record(self, op: str, **fields):
+        # Вызывается после коммита: ошибка журнала не должна откатывать уже исполненную команду
+        if not self.path:
+            return
+        try:
+            if self.__file is None:
+                self.__open()
+            entry = {'seq': self.seq + 1, 'ts': round(time.time(), 6), 'op': op}
+            entry.update(fields)
+            self.__file.write(json.dumps(entry, separators=(',', ':'), default=str) + '\n')
+            self.seq += 1
+        except Exception as e:
+            print(f'journal {self.path}: {op} not recorded: {e}')
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+def read_journal(path: str, limit: Optional[int] = None):
+    with open(path) as f:
+        for n, line in enumerate(f):
+            if limit is not None and n >= limit:
+                return
+            if not line.endswith('\n'):
+                # Недописанная последняя строка после падения
+                return
+            if line.strip():
+                yield json.loads(line)
+
+
+JOURNAL = Journal(JOURNAL_PATH)
@@ -0,0 +1,133 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# Метрики процесса в текстовом формате Prometheus. Запись - пара сложений под GIL,
+# строки собираются только при запросе /metrics
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in self.values.items():
+            lines.append(f'{self.name}{_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    # Значение считается в момент сбора, например размер кэша
+    def __init__(self, name: str, documentation: str, collect: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge',
+                f'{self.name} {self.collect()}']
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам (последняя +Inf), сумма, количество]
+        self.values: Dict[Tuple[str, ...], list] = dict()
+
+    def observe(self, value: float, *labels: str):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+        item[2] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{float(bound)}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {count}')
+        return lines
+
+
+METRICS = []
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_LATENCY = register(Histogram('http_request_duration_seconds', 'HTTP request latency by route',
+                                     ('method', 'route', 'status')))
+ORDER_MATCH = register(Histogram('order_match_seconds', 'Time to find counter orders for an incoming order'))
+ORDER_DB = register(Histogram('order_db_seconds', 'Time to settle fills and write an incoming order'))
+ORDER_COMMIT = register(Histogram('order_commit_seconds', 'Commit time of an incoming order'))
+ORDER_FILLS = register(Histogram('order_fills', 'Fills per incoming order', buckets=COUNT_BUCKETS))
+ORDERS_REJECTED = register(Counter('orders_rejected_total', 'Orders cancelled by the rollback path', ('reason',)))
+POOL_WAIT = register(Histogram('db_pool_checkout_wait_seconds', 'Wait for a connection from the SQLAlchemy pool'))
+
+
+class MetricsMiddleware:
+    # Чистый ASGI, без BaseHTTPMiddleware: не оборачивает тело ответа и не мешает SSE
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Шаблон пути выставляет роутер FastAPI, сырые пути с id раздули бы число рядов
+            route = scope.get('route')
+            REQUEST_LATENCY.observe(time.perf_counter() - started, scope['method'],
+                                    getattr(route, 'path', 'unmatched'), str(status[0]))
@@ -0,0 +1,69 @@
+import asyncio
+import os
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+# Сколько сообщений может накопить один подписчик, дальше он получит новый снапшот
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 1000))
+
+# Маркер в очереди подписчика: пропущены события, нужно прислать снапшот заново
+RESNAPSHOT = None
+
+
+class Subscription:
+    def __init__(self, ticker: str, maxsize: int = STREAM_QUEUE_SIZE):
+        self.ticker = ticker
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def push(self, message: Optional[dict]):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Медленный клиент не должен тормозить матчинг: выкидываем очередь целиком
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.dropped += 1
+            self.queue.put_nowait(RESNAPSHOT)
+
+    async def get(self) -> Optional[dict]:
+        return await self.queue.get()
+
+
+class MarketDataHub:
+    def __init__(self):
+        self.__subscriptions: Dict[str, Set[Subscription]] = defaultdict(set)
+        self.__seq: Dict[str, int] = defaultdict(int)
+
+    def seq(self, ticker: str) -> int:
+        return self.__seq[ticker]
+
+    def subscribe(self, ticker: str) -> Subscription:
+        subscription = Subscription(ticker)
+        self.__subscriptions[ticker].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self.__subscriptions.get(subscription.ticker)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.__subscriptions[subscription.ticker]
+
+    def publish(self, ticker: str, message: dict):
+        self.__seq[ticker] += 1
+        subscribers = self.__subscriptions.get(ticker)
+        if not subscribers:
+            return
+        message["seq"] = self.__seq[ticker]
+        for subscription in subscribers:
+            subscription.push(message)
+
+    def resnapshot(self, ticker: Optional[str] = None):
+        tickers = [ticker] if ticker is not None else list(self.__subscriptions)
+        for t in tickers:
+            for subscription in self.__subscriptions.get(t, ()):
+                subscription.push(RESNAPSHOT)
+
+
+HUB = MarketDataHub()
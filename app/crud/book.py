@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import os
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from core.stream import HUB
+from database.database import engine
+from database.models import Order, DirectionEnum
+
+# memory - стакан держится в памяти процесса, sql - каждый раз читаем стакан из Postgres
+MATCHING_ENGINE = os.getenv('MATCHING_ENGINE', 'memory')
+
+BOOKS: Dict[str, 'OrderBook'] = dict()
+# Сколько строк asyncpg забирает с сервера за раз при загрузке стакана и сколько тикеров грузим одновременно
+BOOK_LOAD_CHUNK = int(os.getenv('BOOK_LOAD_CHUNK', 10000))
+BOOK_LOAD_CONCURRENCY = int(os.getenv('BOOK_LOAD_CONCURRENCY', 4))
+# Целевой бюджет старта на 10M открытых ордеров, время загрузки растет линейно. Это цель, а не замер:
+# фактическую скорость на своей базе показывает bench/startup.py, превышение load_books пишет в лог.
+# Память: ~400 байт на ордер в стакане (BookOrder, UUID ордера, datetime, int, записи в словарях и очереди;
+# UUID пользователя общий на все его ордера), то есть порядка 4 ГБ на 10M
+BOOK_LOAD_BUDGET = float(os.getenv('BOOK_LOAD_BUDGET', 60))
+BOOKS_READY = False
+LOAD_STATS: dict = dict()
+# Номер загрузки стакана, чтобы версии не повторялись после перечитывания из базы
+_generations = itertools.count(1)
+# Счетчик поколений свой в каждом процессе и начинается заново после рестарта, поэтому в ETag добавляем
+# метку запуска процесса: иначе после рестарта, переезда тикера или в другом воркере тот же тег описал бы другой стакан
+_boot = uuid4().hex[:8]
+
+
+def is_resident() -> bool:
+    return MATCHING_ENGINE == 'memory'
+
+
+class BookOrder:
+    __slots__ = ('id', 'user_id', 'direction', 'price', 'amount', 'created_at')
+
+    def __init__(self, id: UUID, user_id: UUID, direction: DirectionEnum, price: int, amount: int,
+                 created_at: datetime):
+        self.id = id
+        self.user_id = user_id
+        self.direction = direction
+        self.price = price
+        self.amount = amount
+        self.created_at = created_at
+
+    @classmethod
+    def from_order(cls, order: Order) -> 'BookOrder':
+        return cls(order.id, order.user_id, order.direction, order.price, order.amount, order.created_at)
+
+
+class PriceLevel:
+    __slots__ = ('price', 'orders', 'total')
+
+    def __init__(self, price: int):
+        self.price = price
+        self.orders: deque = deque()
+        self.total = 0
+
+
+class BookSide:
+    def __init__(self, direction: DirectionEnum):
+        self.direction = direction
+        # Цены храним по возрастанию, для бидов обходим с конца
+        self.prices: List[int] = []
+        self.levels: Dict[int, PriceLevel] = dict()
+
+    def __iter__(self) -> Iterator[PriceLevel]:
+        prices = reversed(self.prices) if self.direction == DirectionEnum.BID else self.prices
+        for price in prices:
+            yield self.levels[price]
+
+    def depth(self, limit: int) -> List[dict]:
+        return [{"price": level.price, "qty": level.total} for level in itertools.islice(self, max(limit, 0))]
+
+    def add(self, order: BookOrder):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = PriceLevel(order.price)
+            self.levels[order.price] = level
+            insort(self.prices, order.price)
+        level.orders.append(order)
+        level.total += order.amount
+
+    def reduce(self, order: BookOrder, amount: int):
+        level = self.levels[order.price]
+        order.amount -= amount
+        level.total -= amount
+        if order.amount == 0:
+            level.orders.remove(order)
+        if not level.orders:
+            self.__drop_level(level.price)
+
+    def remove(self, order: BookOrder):
+        self.reduce(order, order.amount)
+
+    def __drop_level(self, price: int):
+        del self.levels[price]
+        del self.prices[bisect_left(self.prices, price)]
+
+
+class OrderBook:
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.bids = BookSide(DirectionEnum.BID)
+        self.asks = BookSide(DirectionEnum.ASK)
+        self.orders: Dict[UUID, BookOrder] = dict()
+        self.generation = next(_generations)
+        self.version = 0
+        self.__depth_cache: Dict[int, Tuple[int, dict]] = dict()
+
+    @property
+    def tag(self) -> str:
+        return f'"{self.ticker}-{_boot}-{self.generation}-{self.version}"'
+
+    def depth(self, limit: int) -> dict:
+        cached = self.__depth_cache.get(limit)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        depth = {
+            "bid_levels": self.bids.depth(limit),
+            "ask_levels": self.asks.depth(limit)
+        }
+        if len(self.__depth_cache) > 32:
+            self.__depth_cache.clear()
+        self.__depth_cache[limit] = (self.version, depth)
+        return depth
+
+    def side(self, direction: DirectionEnum) -> BookSide:
+        return self.bids if direction == DirectionEnum.BID else self.asks
+
+    def add(self, order: BookOrder):
+        self.orders[order.id] = order
+        self.side(order.direction).add(order)
+        self.version += 1
+
+    def fill(self, order_id: UUID, amount: int):
+        order = self.orders[order_id]
+        self.side(order.direction).reduce(order, amount)
+        if order.amount == 0:
+            del self.orders[order_id]
+        self.version += 1
+
+    def remove(self, order_id: UUID) -> Optional[BookOrder]:
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self.side(order.direction).remove(order)
+            self.version += 1
+        return order
+
+    def match(self, direction: DirectionEnum, qty: int, price: Optional[int]) -> List[Tuple[BookOrder, int]]:
+        # Подбираем встречные ордера для входящей заявки, сам стакан не меняем
+        fills = []
+        opposite = self.asks if direction == DirectionEnum.BID else self.bids
+        for level in opposite:
+            if qty == 0:
+                break
+            if price is not None:
+                if direction == DirectionEnum.BID and level.price > price:
+                    break
+                if direction == DirectionEnum.ASK and level.price < price:
+                    break
+            for order in level.orders:
+                if qty == 0:
+                    break
+                count = min(order.amount, qty)
+                fills.append((order, count))
+                qty -= count
+        return fills
+
+
+# Открытые ордера стороны в порядке приоритета. Запросы совпадают с частичными индексами
+# ix_orders_open_asks / ix_orders_open_bids, так что Postgres отдает строки прямо из индекса без сортировки
+__OPEN_ORDERS = (
+    "SELECT id, user_id, price, amount, created_at FROM orders "
+    "WHERE instrument_ticker = $1 AND status IN ('NEW', 'PARTIALLY_EXECUTED') AND direction = '{direction}' "
+    "AND price IS NOT NULL ORDER BY instrument_ticker, price {order}, created_at, id"
+)
+__SIDE_QUERIES = {
+    DirectionEnum.ASK: __OPEN_ORDERS.format(direction='ASK', order='ASC'),
+    DirectionEnum.BID: __OPEN_ORDERS.format(direction='BID', order='DESC'),
+}
+
+
+async def __stream_side(driver, book: OrderBook, direction: DirectionEnum) -> int:
+    # Строки идут в порядке приоритета, поэтому уровни и очереди собираем добавлением в конец, без insort
+    side = book.side(direction)
+    prices, level, loaded = [], None, 0
+    # asyncpg создает новый UUID на каждую строку, а пользователей в стакане намного меньше, чем ордеров
+    users = dict()
+    cursor = driver.cursor(__SIDE_QUERIES[direction], book.ticker, prefetch=BOOK_LOAD_CHUNK)
+    async for id, user_id, price, amount, created_at in cursor:
+        if level is None or level.price != price:
+            level = side.levels[price] = PriceLevel(price)
+            prices.append(price)
+        order = BookOrder(id, users.setdefault(user_id, user_id), direction, price, amount, created_at)
+        level.orders.append(order)
+        level.total += amount
+        book.orders[id] = order
+        loaded += 1
+    # Биды пришли от дорогих к дешевым, а BookSide хранит цены по возрастанию
+    if direction == DirectionEnum.BID:
+        prices.reverse()
+    side.prices = prices
+    return loaded
+
+
+async def __load_with(driver, ticker: str) -> OrderBook:
+    book = OrderBook(ticker)
+    # Курсор asyncpg живет только внутри транзакции
+    if driver.is_in_transaction():
+        for direction in __SIDE_QUERIES:
+            await __stream_side(driver, book, direction)
+    else:
+        async with driver.transaction(readonly=True):
+            for direction in __SIDE_QUERIES:
+                await __stream_side(driver, book, direction)
+    return book
+
+
+async def load_book(session, ticker: str) -> OrderBook:
+    # Через соединение сессии, чтобы стакан и дальнейший матчинг видели одни и те же данные
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    return await __load_with(raw.driver_connection, ticker)
+
+
+async def load_books(tickers: List[str]) -> dict:
+    # Загрузка стаканов при старте: тикеры параллельно на BOOK_LOAD_CONCURRENCY соединениях,
+    # пока один тикер ждет очередную порцию строк, другой собирается. Пока идет загрузка, is_ready() - False
+    global BOOKS_READY
+    BOOKS_READY = False
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(BOOK_LOAD_CONCURRENCY)
+
+    async def load(ticker: str):
+        async with semaphore:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                book = await __load_with(raw.driver_connection, ticker)
+        BOOKS[ticker] = book
+        HUB.resnapshot(ticker)
+
+    await asyncio.gather(*[load(ticker) for ticker in tickers])
+    elapsed = time.perf_counter() - started
+    orders = sum(len(BOOKS[ticker].orders) for ticker in tickers)
+    LOAD_STATS.update({
+        "tickers": len(tickers),
+        "orders": orders,
+        "seconds": round(elapsed, 3),
+        "orders_per_second": round(orders / elapsed) if elapsed else None,
+        "budget_seconds": BOOK_LOAD_BUDGET * max(orders, 1) / 10 ** 7,
+    })
+    if LOAD_STATS["seconds"] > LOAD_STATS["budget_seconds"] and orders > 10 ** 5:
+        print(f'book load over budget: {LOAD_STATS}')
+    BOOKS_READY = True
+    return LOAD_STATS
+
+
+def is_ready() -> bool:
+    return BOOKS_READY or not is_resident()
+
+
+async def get_book(session, ticker: str) -> OrderBook:
+    # Вызывать под локом тикера
+    book = BOOKS.get(ticker)
+    if book is None:
+        book = await load_book(session, ticker)
+        BOOKS[ticker] = book
+    return book
+
+
+def drop_book(ticker: str):
+    BOOKS.pop(ticker, None)
+    HUB.resnapshot(ticker)
+
+
+def drop_all_books():
+    BOOKS.clear()
+    HUB.resnapshot()
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.database import async_session_maker
+from database.models import Candle, Transaction
+
+# Интервал -> длина свечи. Все интервалы делят сутки, поэтому свечи не пересекают границу дня
+INTERVALS: Dict[str, timedelta] = {
+    '1m': timedelta(minutes=1),
+    '5m': timedelta(minutes=5),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket(timestamp: datetime, interval: str) -> datetime:
+    return timestamp - (timestamp - EPOCH) % INTERVALS[interval]
+
+
+async def record_candles(session: AsyncSession, ticker: str, trades: List[Transaction]):
+    # Сворачиваем сделки ордера в свечи и одним upsert добавляем к тем, что уже в базе.
+    # Сделки по тикеру идут под его локом, поэтому close последнего upsert и есть последняя цена
+    if not trades:
+        return
+    candles: Dict[Tuple[str, datetime], dict] = dict()
+    for trade in trades:
+        for interval in INTERVALS:
+            start = bucket(trade.timestamp, interval)
+            candle = candles.get((interval, start))
+            if candle is None:
+                candles[(interval, start)] = {
+                    'instrument_ticker': ticker, 'interval': interval, 'start': start,
+                    'open': trade.price, 'high': trade.price, 'low': trade.price, 'close': trade.price,
+                    'volume': trade.amount
+                }
+            else:
+                candle['high'] = max(candle['high'], trade.price)
+                candle['low'] = min(candle['low'], trade.price)
+                candle['close'] = trade.price
+                candle['volume'] += trade.amount
+
+    stmt = insert(Candle).values(list(candles.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Candle.instrument_ticker, Candle.interval, Candle.start],
+        set_={
+            'high': func.greatest(Candle.high, stmt.excluded.high),
+            'low': func.least(Candle.low, stmt.excluded.low),
+            'close': stmt.excluded.close,
+            'volume': Candle.volume + stmt.excluded.volume,
+        }
+    )
+    await session.execute(stmt)
+
+
+async def get_candles(ticker: str, interval: str, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                      limit: int = 500) -> List[Candle]:
+    # Последние limit свечей в [start, end), по возрастанию времени. Идет по первичному ключу
+    q = select(Candle).where(Candle.instrument_ticker == ticker, Candle.interval == interval)
+    if start is not None:
+        q = q.where(Candle.start >= bucket(start, interval))
+    if end is not None:
+        q = q.where(Candle.start < end)
+    q = q.order_by(Candle.start.desc()).limit(limit)
+    async with async_session_maker() as session:
+        result = await session.execute(q)
+        return list(reversed(result.scalars().all()))
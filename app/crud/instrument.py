@@ -1,29 +1,70 @@
-import asyncio
-from typing import Optional
+import os
+import time
+from typing import Dict, Optional
 
 from fastapi import HTTPException
 
 from sqlalchemy import select
 
-from crud.locks import LOCKS, acquire_locks
+from crud.locks import LOCKS, acquire_locks, get_lock
+from crud.book import drop_book, is_resident
+from core.journal import JOURNAL
+from crud import shards
+from crud.order import cancel_open_orders
+from crud.transaction import forget_trades
 from database.database import async_session_maker
-from database.models import Instrument, User, UserInventory
+from database.models import Instrument
+
+# ticker -> name. Инструменты меняются только через админку, поэтому держим их в памяти
+INSTRUMENTS: Dict[str, str] = dict()
+# При нескольких воркерах тикер могут удалить в другом процессе: тогда реестр перечитываем не реже раза в
+# INSTRUMENTS_TTL секунд, иначе удаленный тикер оставался бы в памяти навсегда
+INSTRUMENTS_TTL = float(os.getenv('INSTRUMENTS_TTL', 1))
+__loaded_at: Optional[float] = None
+
+
+async def load_instruments():
+    global __loaded_at
+    instruments = await get_all_instruments()
+    INSTRUMENTS.clear()
+    INSTRUMENTS.update({i.ticker: i.name for i in instruments})
+    __loaded_at = time.monotonic()
+
+
+async def __ensure_loaded():
+    if __loaded_at is None or (not is_resident() and time.monotonic() - __loaded_at > INSTRUMENTS_TTL):
+        await load_instruments()
+
+
+async def instrument_exists(ticker: str) -> bool:
+    return await get_instrument_name(ticker) is not None
+
+
+async def get_instrument_name(ticker: str) -> Optional[str]:
+    await __ensure_loaded()
+    name = INSTRUMENTS.get(ticker)
+    if name is None and not is_resident():
+        # Несколько воркеров: инструмент мог создать другой процесс
+        instrument = await get_instrument_by_ticker(ticker)
+        if instrument:
+            name = INSTRUMENTS[ticker] = instrument.name
+    return name
+
+
+async def get_registered_instruments() -> Dict[str, str]:
+    await __ensure_loaded()
+    return INSTRUMENTS
 
 
 async def create_instrument(name: str, ticker: str) -> Instrument:
     async with async_session_maker() as session:
         new_instrument = Instrument(name=name, ticker=ticker)
         session.add(new_instrument)
-
-        result = await session.execute(select(User))
-        users = result.scalars().all()
-
-        for user in users:
-            inv = UserInventory(user=user, instrument=new_instrument, quantity=0.0)
-            session.add(inv)
-
+        # Строки инвентаря под новый тикер появятся при первом зачислении
         await session.commit()
         await session.refresh(new_instrument)
+        INSTRUMENTS[ticker] = name
+        JOURNAL.record('instrument', ticker=ticker, name=name)
         return new_instrument
 
 async def get_instrument_by_ticker(ticker: str) -> Optional[Instrument]:
@@ -34,17 +75,21 @@ async def get_instrument_by_ticker(ticker: str) -> Optional[Instrument]:
         return instrument
 
 async def delete_instrument(ticker: str) -> Instrument:
-    if ticker not in LOCKS:
-        LOCKS[ticker] = asyncio.Lock()
-    lock = LOCKS[ticker]
-
-    async with acquire_locks(lock):
+    async with acquire_locks(get_lock(ticker)):
         async with async_session_maker() as session:
             instrument = await get_instrument_by_ticker(ticker)
             if not instrument:
                 raise HTTPException(status_code=404, detail='Инструмент с данным ticker е найден')
+            # Ордера удалятся каскадом вместе с тикером, но рубли под его заявками на покупку
+            # остались бы замороженными навсегда: сначала снимаем ордера с возвратом замороженного
+            await cancel_open_orders(session, ticker)
             await session.delete(instrument)
             await session.commit()
+            INSTRUMENTS.pop(ticker, None)
+            JOURNAL.record('delete_instrument', ticker=ticker)
+            drop_book(ticker)
+            forget_trades(ticker)
+            await shards.drop_books(ticker)
             return instrument
     LOCKS.pop(ticker)
 
@@ -1,9 +1,11 @@
+import os
 import uuid
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional
 
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 from database.database import async_session_maker
-from database.models import UserInventory
+from database.models import User, UserInventory
 
 async def get_user_inventory(user_id: uuid.UUID, ticker: Optional[str] = None) -> List[UserInventory]:
     async with async_session_maker() as session:
@@ -12,4 +14,54 @@ async def get_user_inventory(user_id: uuid.UUID, ticker: Optional[str] = None) -
             q = select(UserInventory).where(UserInventory.user_id == user_id, UserInventory.instrument_ticker == ticker)
         result = await session.execute(q)
 
-        return result.scalars().all()
\ No newline at end of file
+        return result.scalars().all()
+
+
+async def get_or_create_inventory(session, user_id: uuid.UUID, ticker: str) -> UserInventory:
+    # Строки инвентаря создаются при первом зачислении, до этого считаем остаток нулевым
+    q = select(UserInventory).where(UserInventory.user_id == user_id, UserInventory.instrument_ticker == ticker)
+    inventory = (await session.execute(q)).scalars().first()
+    if inventory is None:
+        await session.execute(
+            insert(UserInventory)
+            .values(user_id=user_id, instrument_ticker=ticker, quantity=0.0, frozen=0.0)
+            .on_conflict_do_nothing(index_elements=[UserInventory.user_id, UserInventory.instrument_ticker])
+        )
+        inventory = (await session.execute(q)).scalars().first()
+    return inventory
+
+
+async def load_inventories(session, user_ids: Iterable[uuid.UUID], ticker: str,
+                           create: Iterable[uuid.UUID] = ()) -> Dict[uuid.UUID, UserInventory]:
+    # Инвентарь нескольких пользователей по тикеру одним запросом, недостающие строки для create - одним upsert
+    user_ids = set(user_ids)
+    q = select(UserInventory).where(UserInventory.user_id.in_(user_ids), UserInventory.instrument_ticker == ticker)
+    inventories = {inv.user_id: inv for inv in (await session.execute(q)).scalars()}
+    missing = set(create) - set(inventories)
+    if missing:
+        await session.execute(
+            insert(UserInventory)
+            .values([{'id': uuid.uuid4(), 'user_id': user_id, 'instrument_ticker': ticker, 'quantity': 0.0, 'frozen': 0.0}
+                     for user_id in missing])
+            .on_conflict_do_nothing(index_elements=[UserInventory.user_id, UserInventory.instrument_ticker])
+        )
+        q = select(UserInventory).where(UserInventory.user_id.in_(missing), UserInventory.instrument_ticker == ticker)
+        inventories.update({inv.user_id: inv for inv in (await session.execute(q)).scalars()})
+    return inventories
+
+
+async def get_user_balances(user_id: uuid.UUID) -> Optional[Dict[str, float]]:
+    # Свободное + замороженное под открытые ордера одним запросом, без обхода ордеров.
+    # Тикеры без строки инвентаря в ответ не попадают
+    async with async_session_maker() as session:
+        q = select(User.balance + User.frozen_balance,
+                   UserInventory.instrument_ticker,
+                   UserInventory.quantity + UserInventory.frozen) \
+            .outerjoin(UserInventory, UserInventory.user_id == User.id) \
+            .where(User.id == user_id)
+        rows = (await session.execute(q)).all()
+        if not rows:
+            return None
+        result = {ticker: quantity for _, ticker, quantity in rows if ticker is not None}
+        result[os.getenv('BASE_INSTRUMENT_TICKER')] = rows[0][0]
+        return result
@@ -1,14 +1,179 @@
+import asyncio
+import contextlib
+import heapq
+import logging
+import os
+import sys
+import time
+from collections import deque
 from contextlib import asynccontextmanager
+from typing import Deque, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from core.metrics import Histogram, register
+from database.database import lock_engine
+
+# local - asyncio.Lock внутри процесса, postgres - advisory lock, работает между процессами
+LOCK_BACKEND = os.getenv('LOCK_BACKEND', 'local')
 
 LOCKS = dict()
+# Сколько последних захватов каждого лока помним для поиска самых долгих
+LOCK_HISTORY = int(os.getenv('LOCK_HISTORY', 256))
+
+LOCK_WAIT = register(Histogram('ticker_lock_wait_seconds', 'Wait for a ticker lock', ('ticker',)))
+LOCK_HOLD = register(Histogram('ticker_lock_hold_seconds', 'Time a ticker lock was held', ('ticker',)))
+logger = logging.getLogger(__name__)
+
+ADVISORY_WAIT = register(Histogram('advisory_lock_wait_seconds', 'Wait for Postgres advisory locks of a lock set'))
+
+
+class TickerLock:
+    # Очередь корутин своего процесса за тикером. При advisory=True это только первая ступень межпроцессного лока:
+    # корутины ждут здесь, не занимая соединений, а сам advisory lock берет acquire_locks,
+    # сразу для всех тикеров набора на одном соединении
+    def __init__(self, key: str, advisory: bool = False):
+        self.key = key
+        self.advisory = advisory
+        self.__lock = asyncio.Lock()
+
+    def locked(self) -> bool:
+        return self.__lock.locked()
+
+    async def acquire(self):
+        await self.__lock.acquire()
+
+    async def release(self):
+        self.__lock.release()
+
+
+class InstrumentedLock:
+    # Обертка над локом тикера: время ожидания и удержания, очередь и самые долгие недавние владельцы
+    def __init__(self, lock):
+        self.key = lock.key
+        self.lock = lock
+        self.waiting = 0
+        self.holder: Optional[str] = None
+        self.held_since: Optional[float] = None
+        # (длительность, код, когда отпустили) последних LOCK_HISTORY захватов
+        self.history: Deque[Tuple[float, str, float]] = deque(maxlen=LOCK_HISTORY)
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    async def acquire(self, path: str = '?'):
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await self.lock.acquire()
+        finally:
+            self.waiting -= 1
+        self.held_since = time.perf_counter()
+        self.holder = path
+        LOCK_WAIT.observe(self.held_since - started, self.key)
+
+    def annotate(self, note: str):
+        # Уточнить ветку кода у текущего владельца, например откат ордера
+        if self.holder is not None:
+            self.holder = f'{self.holder} [{note}]'
+
+    async def release(self):
+        held = time.perf_counter() - self.held_since
+        self.history.append((held, self.holder, time.time()))
+        LOCK_HOLD.observe(held, self.key)
+        self.holder, self.held_since = None, None
+        await self.lock.release()
+
+    def stats(self, top: int = 5) -> dict:
+        wait = LOCK_WAIT.values.get((self.key,))
+        hold = LOCK_HOLD.values.get((self.key,))
+        return {
+            "waiting": self.waiting,
+            "holder": self.holder,
+            "held_for": time.perf_counter() - self.held_since if self.held_since is not None else None,
+            "acquired": hold[2] if hold else 0,
+            "wait_total": wait[1] if wait else 0.0,
+            "hold_total": hold[1] if hold else 0.0,
+            "longest": [
+                {"held": held, "path": path, "released_at": released_at}
+                for held, path, released_at in heapq.nlargest(top, self.history)
+            ]
+        }
+
+
+def get_lock(ticker: str) -> InstrumentedLock:
+    if ticker not in LOCKS:
+        LOCKS[ticker] = InstrumentedLock(TickerLock(ticker, advisory=LOCK_BACKEND == 'postgres'))
+    return LOCKS[ticker]
+
+
+def __caller() -> str:
+    # Первый кадр вне этого модуля и contextlib - тот, кто берет лок
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename in (__file__, contextlib.__file__):
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+
+
+async def __advisory_lock(keys: List[str]):
+    # Одно соединение на набор локов, сколько бы тикеров в нем ни было. Берем его, уже владея локальными локами,
+    # поэтому держатели соединений из пула локов ничего, кроме самих advisory-локов, не ждут
+    started = time.perf_counter()
+    conn = await lock_engine.connect()
+    try:
+        for key in keys:
+            await conn.execute(text('SELECT pg_advisory_lock(hashtext(:key))'), {'key': key})
+        await conn.commit()
+    except BaseException:
+        await conn.invalidate()
+        await conn.close()
+        raise
+    ADVISORY_WAIT.observe(time.perf_counter() - started)
+    return conn
+
+
+async def __advisory_unlock(conn, keys: List[str]):
+    try:
+        for key in reversed(keys):
+            await conn.execute(text('SELECT pg_advisory_unlock(hashtext(:key))'), {'key': key})
+        await conn.commit()
+        await conn.close()
+    except BaseException:
+        # Соединение с неотпущенным локом нельзя возвращать в пул, закрытие сессии Postgres снимет лок.
+        # В том числе при отмене корутины, иначе тикер остался бы залочен для всех процессов
+        logger.exception('advisory unlock failed for %s, dropping the connection', keys)
+        await conn.invalidate()
+        await conn.close()
+        raise
+
 
 @asynccontextmanager
 async def acquire_locks(*locks):
-    locks = sorted(locks, key=id)
-    for lock in locks:
-        await lock.acquire()
+    # Всегда берем локи в одном порядке, чтобы не было взаимных блокировок
+    locks = sorted(set(locks), key=lambda lock: lock.key)
+    advisory = [lock.key for lock in locks if lock.lock.advisory]
+    path = __caller()
+    acquired = []
+    conn = None
     try:
+        for lock in locks:
+            await lock.acquire(path)
+            acquired.append(lock)
+        if advisory:
+            conn = await __advisory_lock(advisory)
         yield
     finally:
-        for lock in reversed(locks):
-            lock.release()
\ No newline at end of file
+        try:
+            if conn is not None:
+                await __advisory_unlock(conn, advisory)
+        finally:
+            for lock in reversed(acquired):
+                await lock.release()
+
+
+def lock_stats(top: int = 5) -> dict:
+    # Тикеры по суммарному времени ожидания, самые горячие первыми
+    stats = {key: lock.stats(top) for key, lock in LOCKS.items()}
+    return dict(sorted(stats.items(), key=lambda item: item[1]["wait_total"], reverse=True))
@@ -1,24 +1,43 @@
 import asyncio
 import os
-from uuid import UUID
-from typing import List, Optional
+from datetime import timezone
+from uuid import UUID, uuid4
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
 from fastapi import HTTPException
-from sqlalchemy import select, asc, desc, delete
-from sqlalchemy.ext.asyncio import AsyncSession
-
-from crud.user import __change_balance
-from crud.locks import LOCKS, acquire_locks
+from sqlalchemy import select, asc, desc, delete, update, and_, or_, tuple_, func
+from sqlalchemy.exc import IntegrityError
+
+from crud.locks import acquire_locks, get_lock
+from crud.book import BOOKS, BookOrder, OrderBook, get_book, is_resident, drop_all_books, drop_book
+from core.stream import HUB
+from core.journal import JOURNAL
+from core.metrics import ORDER_MATCH, ORDER_DB, ORDER_COMMIT, ORDER_FILLS, ORDERS_REJECTED
+from crud import shards
+from crud.transaction import remember_trades
+from crud.candle import record_candles
+from crud.inventory import load_inventories
+from crud.settlement import UPDATE_USERS, UPSERT_INVENTORIES, is_core, settle
 from database.database import async_session_maker
 from database.models import Order, DirectionEnum, User, OrderStatusEnum, Transaction, UserInventory
 
 
 RUB = os.getenv('BASE_INSTRUMENT_TICKER')
+# Сколько встречных ордеров за раз подтягиваем из базы при матчинге без стакана в памяти
+BOOK_CHUNK_SIZE = int(os.getenv('BOOK_CHUNK_SIZE', 50))
+# Сколько разных тикеров может затронуть один пакет ордеров: все их локи держатся до коммита пакета
+ORDER_BATCH_TICKERS = int(os.getenv('ORDER_BATCH_TICKERS', 20))
 
 async def delete_all_orders():
     async with async_session_maker() as session:
         await session.execute(delete(Order))
+        # Вместе с ордерами пропадает и замороженное под них
+        await session.execute(update(User).where(User.frozen_balance != 0).values(frozen_balance=0))
+        await session.execute(update(UserInventory).where(UserInventory.frozen != 0).values(frozen=0))
         await session.commit()
+    JOURNAL.record('delete_all_orders')
+    drop_all_books()
+    await shards.drop_books()
 
 
 async def cancel_order(order_id: str, user_id: UUID) -> Optional[Order]:
@@ -28,26 +47,110 @@ async def cancel_order(order_id: str, user_id: UUID) -> Optional[Order]:
         order: Order = result.scalars().first()
         if not order:
             return None
+        # Не держим соединение из пула, пока ждем лок тикера
+        await session.commit()
+
+        if shards.is_forwarding():
+            response = await shards.call(order.instrument_ticker, {
+                'op': 'cancel', 'order_id': str(order_id), 'user_id': str(user_id)
+            })
+            return shards.order_from_dict(response['order']) if response['order'] else None
 
-        lock = LOCKS[order.instrument_ticker]
+        lock = get_lock(order.instrument_ticker)
         async with acquire_locks(lock):
+            # Строку, прочитанную до лока, мог уже исполнить матчинг или снять параллельная отмена:
+            # статус и объем для разморозки берем только из перечитанной под локом строки
+            q = select(Order).where(Order.id == order.id).with_for_update() \
+                .execution_options(populate_existing=True)
+            order = (await session.execute(q)).scalars().first()
+            if order is None:
+                return None
             if order.status in [OrderStatusEnum.PARTIALLY_EXECUTED, OrderStatusEnum.EXECUTED, OrderStatusEnum.CANCELLED]:
                 raise HTTPException(400, 'Order executed/partially_executed/cancelled')
             if order.price is None:
                 raise HTTPException(400, 'Order is market')
 
             if order.direction == DirectionEnum.ASK:
-                await __change_balance(session, order.user_id, order.instrument_ticker, order.amount)
+                await unfreeze_balance(session, order.user_id, order.instrument_ticker, order.amount)
             elif order.direction == DirectionEnum.BID:
-                await __change_balance(session, order.user_id, RUB, order.amount * order.price)
+                await unfreeze_balance(session, order.user_id, RUB, order.amount * order.price)
             order.status = OrderStatusEnum.CANCELLED
             session.add(order)
             await session.flush()
             await session.refresh(order)
             await session.commit()
+            book = BOOKS.get(order.instrument_ticker)
+            if book is not None and book.remove(order.id) is not None:
+                __publish_levels(book, {(order.direction, order.price)})
+            JOURNAL.record('cancel', order_id=order.id, user_id=order.user_id)
             return order
 
 
+async def cancel_user_orders(user_id: UUID, ticker: Optional[str] = None):
+    # Снимаем открытые ордера пользователя по одному тикеру за раз, остальные тикеры торгуются дальше.
+    # Замороженное возвращаем в той же транзакции: если удаление пользователя потом не пройдет,
+    # он останется с согласованными балансами, а не с навсегда замороженными средствами
+    if ticker is None:
+        async with async_session_maker() as session:
+            q = select(Order.instrument_ticker).where(
+                Order.user_id == user_id,
+                Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED])
+            ).distinct()
+            tickers = (await session.execute(q)).scalars().all()
+        for t in tickers:
+            await cancel_user_orders(user_id, t)
+        return
+
+    if shards.is_forwarding():
+        await shards.call(ticker, {'op': 'cancel_user', 'user_id': str(user_id)})
+        return
+
+    async with acquire_locks(get_lock(ticker)):
+        async with async_session_maker() as session:
+            cancelled = await cancel_open_orders(session, ticker, user_id)
+            await session.commit()
+        book = BOOKS.get(ticker)
+        if book is not None:
+            levels = {(direction, price) for order_id, _, direction, price, _ in cancelled if book.remove(order_id)}
+            __publish_levels(book, levels)
+
+
+async def cancel_open_orders(session, ticker: str, user_id: Optional[UUID] = None) -> list:
+    # Снимает открытые ордера тикера (всех или одного пользователя) и возвращает замороженное под них.
+    # Вызывать под локом тикера, коммит на вызывающей стороне
+    q = (
+        update(Order)
+        .where(
+            Order.instrument_ticker == ticker,
+            Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED])
+        )
+        .values(status=OrderStatusEnum.CANCELLED)
+        .returning(Order.id, Order.user_id, Order.direction, Order.price, Order.amount)
+    )
+    if user_id is not None:
+        q = q.where(Order.user_id == user_id)
+    cancelled = (await session.execute(q)).all()
+    # Рыночные ордера в стакане не стоят и ничего не замораживают
+    rub, qty = dict(), dict()
+    for _, owner, direction, price, amount in cancelled:
+        if price is None:
+            continue
+        if direction == DirectionEnum.BID:
+            rub[owner] = rub.get(owner, 0) + amount * price
+        else:
+            qty[owner] = qty.get(owner, 0) + amount
+    if rub:
+        await session.execute(UPDATE_USERS, {
+            'ids': list(rub), 'balance': list(rub.values()), 'frozen': [-v for v in rub.values()]
+        })
+    if qty:
+        await session.execute(UPSERT_INVENTORIES, {
+            'ticker': ticker, 'row_ids': [uuid4() for _ in qty], 'user_ids': list(qty),
+            'quantity': list(qty.values()), 'frozen': [-v for v in qty.values()]
+        })
+    return cancelled
+
+
 async def get_order(order_id: str) -> Optional[Order]:
     async with async_session_maker() as session:
         q = select(Order).where(Order.id == order_id)
@@ -60,6 +163,39 @@ async def get_orders(ticker: str, direction: DirectionEnum, limit: int = 10) ->
         return await __get_orders(session, ticker, direction, limit)
 
 
+async def get_orderbook(ticker: str, limit: int = 10) -> Tuple[Optional[str], dict]:
+    # Агрегированный стакан на limit ценовых уровней и его тег версии (None без стакана в памяти)
+    if shards.is_forwarding():
+        response = await shards.call(ticker, {'op': 'depth', 'limit': limit})
+        return response['tag'], response['depth']
+
+    if is_resident():
+        book = BOOKS.get(ticker)
+        if book is None:
+            async with acquire_locks(get_lock(ticker)):
+                async with async_session_maker() as session:
+                    book = await get_book(session, ticker)
+        return book.tag, book.depth(limit)
+
+    async with async_session_maker() as session:
+        depth = dict()
+        for direction, key in ((DirectionEnum.BID, "bid_levels"), (DirectionEnum.ASK, "ask_levels")):
+            q = (
+                select(Order.price, func.sum(Order.amount))
+                .filter(
+                    Order.instrument_ticker == ticker,
+                    Order.direction == direction.name,
+                    Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]),
+                    Order.price.isnot(None)
+                )
+                .group_by(Order.price)
+                .order_by(desc(Order.price) if direction == DirectionEnum.BID else asc(Order.price))
+                .limit(limit)
+            )
+            depth[key] = [{"price": price, "qty": qty} for price, qty in (await session.execute(q)).all()]
+        return None, depth
+
+
 async def __get_orders(session, ticker: str, direction: DirectionEnum, limit: int = 10) -> List[Order]:
     q = (
         select(Order)
@@ -78,102 +214,317 @@ async def __get_orders(session, ticker: str, direction: DirectionEnum, limit: in
     return result.scalars().all()
 
 
-async def create_limit_buy_order(ticker, qty, price, user: User):
-    if ticker not in LOCKS:
-        LOCKS[ticker] = asyncio.Lock()
-    order_lock = LOCKS[ticker]
-    async with acquire_locks(order_lock):
-        async with async_session_maker() as session:
-            orderbook = await __get_orders(session, ticker, DirectionEnum.ASK, qty)
-            new_order = Order(
-                user_id=user.id,
-                instrument_ticker=ticker,
-                amount=qty,
-                filled=0,
-                price=price,
-                direction=DirectionEnum.BID,
-                status=OrderStatusEnum.NEW
-            )
-            try:
-                # Скупаем все что можно
-                for order in orderbook:
-                    if new_order.amount == 0 or (price is not None and order.price > price):
-                        break
-                    count_to_buy = min(order.amount, new_order.amount)
-                    await buy(session, order.user_id, user.id, ticker, order.price, count_to_buy)
-                    await partially_execute_order(session, order, count_to_buy)
-                    await partially_execute_order(session, new_order, count_to_buy)
-
-                # Замораживаем баланс для остатка ордера
-                if new_order.status != OrderStatusEnum.EXECUTED:
-                    if price is not None:
-                        await freeze_balance(session, user.id, RUB, new_order.amount * new_order.price)
-                    else:
-                        raise Exception('Not enough orders')
+async def __walk_orders(session, ticker: str, direction: DirectionEnum, price_limit: Optional[int] = None,
+                        chunk: int = BOOK_CHUNK_SIZE) -> AsyncIterator[Order]:
+    # Обходим стакан порциями по ключу (price, created_at, id), а не грузим его целиком
+    last: Optional[Order] = None
+    while True:
+        q = select(Order).filter(
+            Order.instrument_ticker == ticker,
+            Order.direction == direction.name,
+            Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]),
+            Order.price.isnot(None)
+        )
+        if price_limit is not None:
+            q = q.filter(Order.price >= price_limit if direction == DirectionEnum.BID else Order.price <= price_limit)
+        if last is not None:
+            worse_price = Order.price < last.price if direction == DirectionEnum.BID else Order.price > last.price
+            q = q.filter(or_(
+                worse_price,
+                and_(Order.price == last.price, tuple_(Order.created_at, Order.id) > tuple_(last.created_at, last.id))
+            ))
+        q = q.order_by(
+            desc(Order.price) if direction == DirectionEnum.BID else asc(Order.price),
+            Order.created_at,
+            Order.id
+        ).limit(chunk)
+        orders = (await session.execute(q)).scalars().all()
+        for order in orders:
+            yield order
+        if len(orders) < chunk:
+            return
+        last = orders[-1]
+
+
+__OPEN = (OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED)
+
+
+async def __match_orders(session, ticker: str, direction: DirectionEnum, qty: int,
+                         price: Optional[int]) -> List[Tuple[Order, int]]:
+    # Возвращает встречные ордера и объем сделки по каждому, ничего не меняя
+    if not is_resident():
+        opposite = DirectionEnum.ASK if direction == DirectionEnum.BID else DirectionEnum.BID
+        fills = []
+        orders = __walk_orders(session, ticker, opposite, price)
+        async for order in orders:
+            count = min(order.amount, qty)
+            fills.append((order, count))
+            qty -= count
+            if qty == 0:
+                break
+        await orders.aclose()
+        return fills
+
+    book = await get_book(session, ticker)
+    fills = []
+    matched = book.match(direction, qty, price)
+    # Строки встречных ордеров одним запросом, а не по одному на сделку
+    ids = [book_order.id for book_order, _ in matched]
+    orders = {o.id: o for o in (await session.execute(select(Order).where(Order.id.in_(ids)))).scalars()} if ids else {}
+    for book_order, count in matched:
+        order = orders.get(book_order.id)
+        if order is None or order.amount != book_order.amount or order.status not in __OPEN:
+            # Стакан разошелся с базой (например, удалили пользователя или сняли ордер), перечитываем его
+            drop_book(ticker)
+            return await __match_orders(session, ticker, direction, qty, price)
+        fills.append((order, count))
+    return fills
+
+
+def __pretty_trade(transaction: Transaction) -> dict:
+    return {
+        "type": "trade",
+        "ticker": transaction.instrument_ticker,
+        "amount": transaction.amount,
+        "price": transaction.price,
+        "timestamp": transaction.timestamp.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+    }
+
+
+def __publish_levels(book: OrderBook, levels: Set[Tuple[DirectionEnum, int]]):
+    for direction, price in levels:
+        level = book.side(direction).levels.get(price)
+        HUB.publish(book.ticker, {
+            "type": "level",
+            "side": "bid" if direction == DirectionEnum.BID else "ask",
+            "price": price,
+            "qty": level.total if level is not None else 0
+        })
+
+
+def __apply_to_book(ticker: str, fills: List[Tuple[Order, int]], new_order: Order) -> Set[Tuple[DirectionEnum, int]]:
+    # Возвращает затронутые ценовые уровни стакана
+    levels = set()
+    book = BOOKS.get(ticker)
+    if not is_resident() or book is None:
+        return levels
+    try:
+        for order, count in fills:
+            book.fill(order.id, count)
+            levels.add((order.direction, order.price))
+        if new_order.price is not None and new_order.amount > 0:
+            book.add(BookOrder.from_order(new_order))
+            levels.add((new_order.direction, new_order.price))
+    except Exception as e:
+        print(e)
+        drop_book(ticker)
+    return levels
+
+
+def __publish(ticker: str, trades: List[Transaction], levels: Set[Tuple[DirectionEnum, int]]):
+    try:
+        remember_trades(ticker, trades)
+        for transaction in trades:
+            HUB.publish(ticker, __pretty_trade(transaction))
+        book = BOOKS.get(ticker)
+        if book is not None:
+            __publish_levels(book, levels)
+    except Exception as e:
+        print(e)
+
+
+def __after_commit(ticker: str, fills: List[Tuple[Order, int]], new_order: Order,
+                   trades: List[Transaction]):
+    # Стакан в памяти меняем только после коммита, чтобы откат транзакции его не касался.
+    # Между изменением стакана и рассылкой нет await, поэтому подписчики видят согласованную картину
+    __publish(ticker, trades, __apply_to_book(ticker, fills, new_order))
+
+
+def __new_order(user_id: UUID, ticker: str, direction: DirectionEnum, qty: int, price: Optional[int]) -> Order:
+    return Order(
+        user_id=user_id,
+        instrument_ticker=ticker,
+        amount=qty,
+        filled=0,
+        price=price,
+        direction=direction,
+        status=OrderStatusEnum.NEW
+    )
 
-                session.add(new_order)
-                await session.commit()
-                return new_order
 
+def __journal_order(order: Order, qty: int):
+    # Исходная команда и ее итог: при воспроизведении итог должен совпасть
+    JOURNAL.record('order', order_id=order.id, user_id=order.user_id, ticker=order.instrument_ticker,
+                   direction=order.direction.name, qty=qty, price=order.price,
+                   status=order.status.name, filled=order.filled)
+
+
+def __count_rejected(e: Exception):
+    # Свои отказы бросаем голым Exception с фиксированным текстом, прочие ошибки считаем по типу
+    ORDERS_REJECTED.inc(str(e) if type(e) is Exception else type(e).__name__)
+
+
+def __cancel_new_order(new_order: Order, qty: int):
+    new_order.filled = 0
+    new_order.amount = qty
+    new_order.status = OrderStatusEnum.CANCELLED
+
+
+async def __execute_order(session, new_order: Order) -> Tuple[List[Tuple[Order, int]], List[Transaction]]:
+    # Матчит новый ордер и добавляет его в сессию. Коммит и откат на вызывающей стороне
+    with ORDER_MATCH.time():
+        fills = await __match_orders(session, new_order.instrument_ticker, new_order.direction, new_order.amount,
+                                     new_order.price)
+    ORDER_FILLS.observe(len(fills))
+    with ORDER_DB.time():
+        if is_core():
+            trades = await settle(session, new_order, fills)
+        else:
+            trades = await __settle(session, new_order, fills)
+        await record_candles(session, new_order.instrument_ticker, trades)
+    return fills, trades
+
+
+async def __settle(session, new_order: Order, fills: List[Tuple[Order, int]]) -> List[Transaction]:
+    # Пользователей и инвентарь всех участников грузим заранее пачкой, в базу пишем одним flush в конце
+    ticker, price, user_id = new_order.instrument_ticker, new_order.price, new_order.user_id
+    trades = []
+    makers = {order.user_id for order, _ in fills}
+    buyers = {user_id} if new_order.direction == DirectionEnum.BID else makers
+    users = {u.id: u for u in (await session.execute(select(User).where(User.id.in_(makers | {user_id})))).scalars()}
+    inventories = dict()
+    if fills or new_order.direction == DirectionEnum.ASK:
+        inventories = await load_inventories(session, makers | {user_id}, ticker, buyers if fills else ())
+    for order, count in fills:
+        if new_order.direction == DirectionEnum.BID:
+            # Скупаем все что можно
+            trades.append(buy(users[order.user_id], users[user_id], inventories.get(order.user_id),
+                              inventories.get(user_id), ticker, order.price, count))
+        else:
+            # Продаем все что можно
+            trades.append(sell(users[user_id], users[order.user_id], inventories.get(user_id),
+                               inventories.get(order.user_id), ticker, order.price, count))
+        partially_execute_order(order, count)
+        partially_execute_order(new_order, count)
+    session.add_all(trades)
+
+    # Замораживаем баланс или инструменты для остатка ордера
+    if new_order.status != OrderStatusEnum.EXECUTED:
+        if price is None:
+            raise Exception('Not enough orders')
+        if new_order.direction == DirectionEnum.BID:
+            __freeze(users[user_id], None, RUB, new_order.amount * price)
+        else:
+            __freeze(users[user_id], inventories.get(user_id), ticker, new_order.amount)
+
+    session.add(new_order)
+    await session.flush()
+    return trades
+
+
+async def __create_order(ticker: str, qty: int, price: Optional[int], user: User, direction: DirectionEnum) -> Order:
+    if shards.is_forwarding():
+        response = await shards.call(ticker, {
+            'op': 'order', 'direction': direction.name, 'qty': qty, 'price': price, 'user_id': str(user.id)
+        })
+        return shards.order_from_dict(response['order'])
+
+    async with acquire_locks(get_lock(ticker)):
+        async with async_session_maker() as session:
+            new_order = __new_order(user.id, ticker, direction, qty, price)
+            try:
+                fills, trades = await __execute_order(session, new_order)
+                with ORDER_COMMIT.time():
+                    await session.commit()
             except Exception as e:
-                # Не хватило денег
+                # Не хватило денег или инструментов
                 print(e)
+                __count_rejected(e)
+                get_lock(ticker).annotate('rollback')
                 await session.rollback()
-                new_order.filled = 0
-                new_order.amount = qty
-                new_order.status = OrderStatusEnum.CANCELLED
+                __cancel_new_order(new_order, qty)
                 session.add(new_order)
-                await session.commit()
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Пользователя или тикер уже удалили (другим воркером), отказ сохранить некуда
+                    await session.rollback()
+                    raise HTTPException(404, 'User or instrument not found')
+                __journal_order(new_order, qty)
                 return new_order
+            # После коммита ничего не должно попасть в ветку отката выше
+            __after_commit(ticker, fills, new_order, trades)
+            __journal_order(new_order, qty)
+            return new_order
+
+
+async def create_limit_buy_order(ticker, qty, price, user: User):
+    return await __create_order(ticker, qty, price, user, DirectionEnum.BID)
 
 
 async def create_limit_sell_order(ticker, qty, price, user: User):
-    if ticker not in LOCKS:
-        LOCKS[ticker] = asyncio.Lock()
-    order_lock = LOCKS[ticker]
-    async with acquire_locks(order_lock):
-        async with async_session_maker() as session:
-            orderbook = await __get_orders(session, ticker, DirectionEnum.BID, qty)
-            new_order = Order(
-                user_id=user.id,
-                instrument_ticker=ticker,
-                amount=qty,
-                filled=0,
-                price=price,
-                direction=DirectionEnum.ASK,
-                status=OrderStatusEnum.NEW
-            )
-            try:
-                # Продаем все что можно
-                for order in orderbook:
-                    if new_order.amount == 0 or (price is not None and order.price < price):
-                        break
-                    count_to_sell = min(order.amount, new_order.amount)
-                    await sell(session, user.id, order.user_id, ticker, order.price, count_to_sell)
-                    await partially_execute_order(session, order, count_to_sell)
-                    await partially_execute_order(session, new_order, count_to_sell)
-
-                # Замораживаем инструменты
-                if new_order.status != OrderStatusEnum.EXECUTED:
-                    if price is not None:
-                        await freeze_balance(session, user.id, ticker, new_order.amount)
-                    else:
-                        raise Exception('Not enough orders')
+    return await __create_order(ticker, qty, price, user, DirectionEnum.ASK)
 
-                session.add(new_order)
-                await session.commit()
-                return new_order
 
+async def create_orders_batch(orders: List[Tuple[DirectionEnum, str, int, Optional[int]]], user: User) -> List[Order]:
+    # Все тикеры пакета лочим один раз и коммитим одной транзакцией.
+    # Каждый ордер исполняется в своем savepoint, неудачный откатывается только он и сохраняется как CANCELLED
+    tickers = {ticker for _, ticker, _, _ in orders}
+    if len(tickers) > ORDER_BATCH_TICKERS:
+        raise HTTPException(400, f'Batch spans more than {ORDER_BATCH_TICKERS} tickers')
+    if shards.is_forwarding():
+        return await __forward_batch(orders, user, tickers)
+
+    async with acquire_locks(*[get_lock(ticker) for ticker in tickers]):
+        async with async_session_maker() as session:
+            result = []
+            published = []
+            for direction, ticker, qty, price in orders:
+                new_order = __new_order(user.id, ticker, direction, qty, price)
+                try:
+                    async with session.begin_nested():
+                        fills, trades = await __execute_order(session, new_order)
+                except Exception as e:
+                    print(e)
+                    __count_rejected(e)
+                    __cancel_new_order(new_order, qty)
+                    session.add(new_order)
+                    result.append((new_order, qty))
+                    continue
+                # Следующие ордера пакета должны видеть изменения стакана
+                published.append((ticker, trades, __apply_to_book(ticker, fills, new_order)))
+                result.append((new_order, qty))
+
+            try:
+                with ORDER_COMMIT.time():
+                    await session.commit()
             except Exception as e:
-                # Не хватило инструментов
-                print(e)
-                await session.rollback()
-                new_order.filled = 0
-                new_order.amount = qty
-                new_order.status = OrderStatusEnum.CANCELLED
-                session.add(new_order)
-                await session.commit()
-                return new_order
+                for ticker in tickers:
+                    drop_book(ticker)
+                if isinstance(e, IntegrityError):
+                    raise HTTPException(404, 'User or instrument not found')
+                raise
+            for new_order, qty in result:
+                __journal_order(new_order, qty)
+            for ticker, trades, levels in published:
+                __publish(ticker, trades, levels)
+            return [new_order for new_order, _ in result]
+
+
+async def __forward_batch(orders: List[Tuple[DirectionEnum, str, int, Optional[int]]], user: User,
+                          tickers: Set[str]) -> List[Order]:
+    # Тикеры могут жить в разных шардах, поэтому отправляем по пакету на тикер, каждый коммитится отдельно
+    tickers = list(tickers)
+    responses = await asyncio.gather(*[
+        shards.call(ticker, {
+            'op': 'batch',
+            'user_id': str(user.id),
+            'orders': [(d.name, t, qty, price) for d, t, qty, price in orders if t == ticker]
+        })
+        for ticker in tickers
+    ])
+    created = {ticker: iter(response['orders']) for ticker, response in zip(tickers, responses)}
+    return [shards.order_from_dict(next(created[ticker])) for _, ticker, _, _ in orders]
 
 
 async def create_market_buy_order(ticker, qty, user: User):
@@ -184,70 +535,65 @@ async def create_market_sell_order(ticker, qty, user: User):
     return await create_limit_sell_order(ticker, qty, None, user)
 
 
-async def buy(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
-    buyer = await session.get(User, buyer_id)
-    seller = await session.get(User, seller_id)
-
-    buyer_q = select(UserInventory).where(UserInventory.user_id == buyer_id,
-                                          UserInventory.instrument_ticker == ticker)
-    buyer_inv = (await session.execute(buyer_q)).scalars().first()
-
+def buy(seller: User, buyer: User, seller_inv: UserInventory, buyer_inv: UserInventory, ticker: str,
+        price: int, amount: int) -> Transaction:
     if buyer.balance < amount * price:
         raise Exception('Not enough balance')
 
     transaction = Transaction(
-        user_from_id=seller_id,
-        user_to_id=buyer_id,
+        user_from_id=seller.id,
+        user_to_id=buyer.id,
         instrument_ticker=ticker,
         amount=amount,
         price=price
     )
-    session.add(transaction)
     seller.balance += amount * price
     buyer.balance -= amount * price
     buyer_inv.quantity += amount
-
-    await session.flush()
+    # Инструменты продавца были заморожены под его ордер
+    seller_inv.frozen -= amount
     return transaction
 
 
-async def sell(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
-    seller = await session.get(User, seller_id)
-
-    seller_q = select(UserInventory).where(UserInventory.user_id == seller_id,
-                                           UserInventory.instrument_ticker == ticker)
-    seller_inv = (await session.execute(seller_q)).scalars().first()
-
-    buyer_q = select(UserInventory).where(UserInventory.user_id == buyer_id,
-                                          UserInventory.instrument_ticker == ticker)
-    buyer_inv = (await session.execute(buyer_q)).scalars().first()
-
-    if seller_inv.quantity < amount:
+def sell(seller: User, buyer: User, seller_inv: Optional[UserInventory], buyer_inv: UserInventory, ticker: str,
+         price: int, amount: int) -> Transaction:
+    if seller_inv is None or seller_inv.quantity < amount:
         raise Exception('Not enough instruments')
 
     transaction = Transaction(
-        user_from_id=seller_id,
-        user_to_id=buyer_id,
+        user_from_id=seller.id,
+        user_to_id=buyer.id,
         instrument_ticker=ticker,
         amount=amount,
         price=price
     )
-    session.add(transaction)
     seller.balance += amount * price
     seller_inv.quantity -= amount
     buyer_inv.quantity += amount
-
-    await session.flush()
+    # Деньги покупателя были заморожены под его ордер по этой же цене
+    buyer.frozen_balance -= amount * price
     return transaction
 
 
-async def partially_execute_order(session: AsyncSession, order: Order, amount: int):
+def partially_execute_order(order: Order, amount: int):
     if order.amount < amount:
         raise Exception('Order not enough amount')
     order.amount -= amount
     order.filled += amount
     order.status = OrderStatusEnum.EXECUTED if order.amount == 0 else OrderStatusEnum.PARTIALLY_EXECUTED
-    await session.flush()
+
+
+def __freeze(user: User, inventory: Optional[UserInventory], ticker: str, amount: int):
+    # Нет строки инвентаря - нет и инструментов
+    balance = user.balance if ticker == RUB else (inventory.quantity if inventory is not None else 0)
+    if balance < amount:
+        raise Exception('User not enough balance/instruments')
+    if ticker != RUB:
+        inventory.quantity -= amount
+        inventory.frozen += amount
+    else:
+        user.balance -= amount
+        user.frozen_balance += amount
 
 
 async def freeze_balance(session, user_id: UUID, ticker: str, amount: int):
@@ -257,14 +603,7 @@ async def freeze_balance(session, user_id: UUID, ticker: str, amount: int):
         q = select(UserInventory).where(UserInventory.user_id == user.id,
                                         UserInventory.instrument_ticker == ticker)
         inventory = (await session.execute(q)).scalars().first()
-
-    balance = user.balance if ticker == RUB else inventory.quantity
-    if balance < amount:
-        raise Exception('User not enough balance/instruments')
-    if ticker != RUB:
-        inventory.quantity -= amount
-    else:
-        user.balance -= amount
+    __freeze(user, inventory, ticker, amount)
     await session.flush()
 
 
@@ -274,7 +613,9 @@ async def unfreeze_balance(session, user_id: UUID, ticker: str, amount: int):
                                         UserInventory.instrument_ticker == ticker)
         inventory = (await session.execute(q)).scalars().first()
         inventory.quantity += amount
+        inventory.frozen -= amount
     else:
         user = await session.get(User, user_id)
         user.balance += amount
+        user.frozen_balance -= amount
     await session.flush()
@@ -0,0 +1,200 @@
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.orm.attributes import set_committed_value
+
+from database.models import Order, OrderStatusEnum, DirectionEnum, User, UserInventory, Transaction
+
+# orm - изменения через unit of work (UPDATE на каждый объект), core - несколько set-based запросов на ордер
+SETTLEMENT = os.getenv('SETTLEMENT', 'orm')
+RUB = os.getenv('BASE_INSTRUMENT_TICKER')
+
+# Текст запросов не зависит от числа сделок, поэтому asyncpg готовит каждый один раз на соединение
+UPDATE_USERS = text(
+    'UPDATE users SET balance = users.balance + d.balance, frozen_balance = users.frozen_balance + d.frozen '
+    'FROM unnest(CAST(:ids AS uuid[]), CAST(:balance AS float8[]), CAST(:frozen AS float8[])) '
+    'AS d(id, balance, frozen) '
+    'WHERE users.id = d.id'
+)
+UPSERT_INVENTORIES = text(
+    'INSERT INTO user_inventories (id, user_id, instrument_ticker, quantity, frozen) '
+    'SELECT d.id, d.user_id, :ticker, d.quantity, d.frozen '
+    'FROM unnest(CAST(:row_ids AS uuid[]), CAST(:user_ids AS uuid[]), CAST(:quantity AS float8[]), '
+    'CAST(:frozen AS float8[])) AS d(id, user_id, quantity, frozen) '
+    'ON CONFLICT (user_id, instrument_ticker) DO UPDATE SET '
+    'quantity = user_inventories.quantity + excluded.quantity, frozen = user_inventories.frozen + excluded.frozen'
+)
+UPDATE_ORDERS = text(
+    'UPDATE orders SET amount = d.amount, filled = d.filled, status = d.status '
+    'FROM unnest(CAST(:ids AS uuid[]), CAST(:amount AS int[]), CAST(:filled AS int[]), '
+    'CAST(:status AS orderstatusenum[])) AS d(id, amount, filled, status) '
+    'WHERE orders.id = d.id'
+)
+INSERT_TRANSACTIONS = text(
+    'INSERT INTO transactions (id, user_from_id, user_to_id, instrument_ticker, amount, price, timestamp) '
+    'SELECT d.id, d.user_from_id, d.user_to_id, :ticker, d.amount, d.price, d.timestamp '
+    'FROM unnest(CAST(:ids AS uuid[]), CAST(:user_from AS uuid[]), CAST(:user_to AS uuid[]), '
+    'CAST(:amount AS float8[]), CAST(:price AS float8[]), CAST(:timestamp AS timestamp[])) '
+    'AS d(id, user_from_id, user_to_id, amount, price, timestamp)'
+)
+
+
+def is_core() -> bool:
+    return SETTLEMENT == 'core'
+
+
+class Ledger:
+    # Накопленные изменения балансов по пользователям. Текущие значения знаем только для тейкера,
+    # мейкерам хватает дельт: их деньги и инструменты уже заморожены под ордера
+    def __init__(self, taker: User, inventory: Optional[UserInventory]):
+        self.taker = taker
+        self.inventory = inventory
+        self.balance: Dict[uuid.UUID, float] = dict()
+        self.frozen_balance: Dict[uuid.UUID, float] = dict()
+        self.quantity: Dict[uuid.UUID, float] = dict()
+        self.frozen: Dict[uuid.UUID, float] = dict()
+
+    @staticmethod
+    def add(deltas: Dict[uuid.UUID, float], user_id: uuid.UUID, amount: float):
+        deltas[user_id] = deltas.get(user_id, 0) + amount
+
+    def taker_balance(self) -> float:
+        return self.taker.balance + self.balance.get(self.taker.id, 0)
+
+    def taker_quantity(self) -> Optional[float]:
+        if self.inventory is None and self.taker.id not in self.quantity:
+            return None
+        base = self.inventory.quantity if self.inventory is not None else 0
+        return base + self.quantity.get(self.taker.id, 0)
+
+
+def __fill_values(order: Order, count: int) -> Tuple[int, int, OrderStatusEnum]:
+    if order.amount < count:
+        raise Exception('Order not enough amount')
+    amount = order.amount - count
+    return amount, order.filled + count, OrderStatusEnum.EXECUTED if amount == 0 else OrderStatusEnum.PARTIALLY_EXECUTED
+
+
+async def settle(session, new_order: Order, fills: List[Tuple[Order, int]]) -> List[Transaction]:
+    # То же, что ORM-ветка __execute_order: те же проверки в том же порядке и те же итоговые строки,
+    # но изменения копятся в памяти и пишутся четырьмя запросами. new_order остается в сессии как обычно
+    ticker, price, user_id = new_order.instrument_ticker, new_order.price, new_order.user_id
+    bid = new_order.direction == DirectionEnum.BID
+    # populate_existing: в пакетном режиме объекты в сессии могли устареть после прошлых set-based запросов
+    taker = (await session.execute(
+        select(User).where(User.id == user_id).execution_options(populate_existing=True)
+    )).scalars().one()
+    inventory = None
+    if fills or not bid:
+        inventory = (await session.execute(
+            select(UserInventory)
+            .where(UserInventory.user_id == user_id, UserInventory.instrument_ticker == ticker)
+            .execution_options(populate_existing=True)
+        )).scalars().first()
+    ledger = Ledger(taker, inventory)
+
+    trades, order_rows = [], []
+    for order, count in fills:
+        volume = count * order.price
+        if bid:
+            if ledger.taker_balance() < volume:
+                raise Exception('Not enough balance')
+            seller_id, buyer_id = order.user_id, user_id
+            ledger.add(ledger.balance, seller_id, volume)
+            ledger.add(ledger.balance, buyer_id, -volume)
+            ledger.add(ledger.quantity, buyer_id, count)
+            ledger.add(ledger.frozen, seller_id, -count)
+        else:
+            quantity = ledger.taker_quantity()
+            if quantity is None or quantity < count:
+                raise Exception('Not enough instruments')
+            seller_id, buyer_id = user_id, order.user_id
+            ledger.add(ledger.balance, seller_id, volume)
+            ledger.add(ledger.quantity, seller_id, -count)
+            ledger.add(ledger.quantity, buyer_id, count)
+            ledger.add(ledger.frozen_balance, buyer_id, -volume)
+        trades.append(Transaction(
+            id=uuid.uuid4(),
+            user_from_id=seller_id,
+            user_to_id=buyer_id,
+            instrument_ticker=ticker,
+            amount=count,
+            price=order.price,
+            timestamp=datetime.utcnow()
+        ))
+        order_rows.append((order, __fill_values(order, count)))
+        new_order.amount, new_order.filled, new_order.status = __fill_values(new_order, count)
+
+    # Замораживаем остаток ордера
+    if new_order.status != OrderStatusEnum.EXECUTED:
+        if price is None:
+            raise Exception('Not enough orders')
+        if bid:
+            amount = new_order.amount * price
+            if ledger.taker_balance() < amount:
+                raise Exception('User not enough balance/instruments')
+            ledger.add(ledger.balance, user_id, -amount)
+            ledger.add(ledger.frozen_balance, user_id, amount)
+        else:
+            quantity = ledger.taker_quantity()
+            if quantity is None or quantity < new_order.amount:
+                raise Exception('User not enough balance/instruments')
+            ledger.add(ledger.quantity, user_id, -new_order.amount)
+            ledger.add(ledger.frozen, user_id, new_order.amount)
+
+    await __write(session, ticker, ledger, order_rows, trades)
+    session.add(new_order)
+    await session.flush()
+    return trades
+
+
+async def __write(session, ticker: str, ledger: Ledger, order_rows, trades: List[Transaction]):
+    users = sorted(set(ledger.balance) | set(ledger.frozen_balance))
+    if users:
+        await session.execute(UPDATE_USERS, {
+            'ids': users,
+            'balance': [float(ledger.balance.get(u, 0)) for u in users],
+            'frozen': [float(ledger.frozen_balance.get(u, 0)) for u in users],
+        })
+    holders = sorted(set(ledger.quantity) | set(ledger.frozen))
+    if holders:
+        await session.execute(UPSERT_INVENTORIES, {
+            'ticker': ticker,
+            'row_ids': [uuid.uuid4() for _ in holders],
+            'user_ids': holders,
+            'quantity': [float(ledger.quantity.get(u, 0)) for u in holders],
+            'frozen': [float(ledger.frozen.get(u, 0)) for u in holders],
+        })
+    if order_rows:
+        await session.execute(UPDATE_ORDERS, {
+            'ids': [order.id for order, _ in order_rows],
+            'amount': [amount for _, (amount, _, _) in order_rows],
+            'filled': [filled for _, (_, filled, _) in order_rows],
+            'status': [status.name for _, (_, _, status) in order_rows],
+        })
+    if trades:
+        await session.execute(INSERT_TRANSACTIONS, {
+            'ticker': ticker,
+            'ids': [t.id for t in trades],
+            'user_from': [t.user_from_id for t in trades],
+            'user_to': [t.user_to_id for t in trades],
+            'amount': [float(t.amount) for t in trades],
+            'price': [float(t.price) for t in trades],
+            'timestamp': [t.timestamp for t in trades],
+        })
+
+    # Записанное выше сессия не отслеживает: обновляем объекты без пометки dirty, чтобы flush не писал их второй раз
+    for order, (amount, filled, status) in order_rows:
+        set_committed_value(order, 'amount', amount)
+        set_committed_value(order, 'filled', filled)
+        set_committed_value(order, 'status', status)
+    taker_id = ledger.taker.id
+    set_committed_value(ledger.taker, 'balance', ledger.taker_balance())
+    set_committed_value(ledger.taker, 'frozen_balance',
+                        ledger.taker.frozen_balance + ledger.frozen_balance.get(taker_id, 0))
+    if ledger.inventory is not None:
+        set_committed_value(ledger.inventory, 'quantity', ledger.taker_quantity())
+        set_committed_value(ledger.inventory, 'frozen', ledger.inventory.frozen + ledger.frozen.get(taker_id, 0))
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+from database.models import Order, DirectionEnum, OrderStatusEnum
+
+# Количество процессов матчинга. 0 - матчим прямо в HTTP-воркере
+MATCHING_SHARDS = int(os.getenv('MATCHING_SHARDS', 0))
+SHARD_SOCKET_DIR = os.getenv('SHARD_SOCKET_DIR', '/tmp')
+SHARD_POOL_SIZE = int(os.getenv('SHARD_POOL_SIZE', 8))
+# Сколько HTTP-процесс ждет, пока шарды загрузят стаканы и откроют сокеты
+SHARD_START_TIMEOUT = float(os.getenv('SHARD_START_TIMEOUT', 600))
+
+# Номер шарда, если код выполняется внутри процесса матчинга (выставляет shard.py)
+SHARD_INDEX: Optional[int] = None
+
+# Явные назначения тикер -> шард поверх хеша, начальные берем из SHARD_MAP="AAA=0,BBB=1"
+ASSIGNMENT: Dict[str, int] = {
+    ticker: int(shard)
+    for ticker, shard in (item.split('=') for item in os.getenv('SHARD_MAP', '').split(',') if item)
+}
+
+# Тикеры, которые переезжают в этот шард: запросы по ним ждут, пока старый владелец не выгрузит стакан
+MOVING: Dict[str, asyncio.Event] = dict()
+
+__pools: Dict[int, asyncio.Queue] = dict()
+
+
+def is_forwarding() -> bool:
+    return MATCHING_SHARDS > 0 and SHARD_INDEX is None
+
+
+def shard_for(ticker: str) -> int:
+    if ticker in ASSIGNMENT:
+        return ASSIGNMENT[ticker]
+    return zlib.crc32(ticker.encode()) % MATCHING_SHARDS
+
+
+def socket_path(shard: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f'tochka-shard-{shard}.sock')
+
+
+async def __connection(shard: int):
+    pool = __pools.get(shard)
+    if pool is None:
+        pool = __pools[shard] = asyncio.Queue()
+        for _ in range(SHARD_POOL_SIZE):
+            pool.put_nowait(None)
+    conn = await pool.get()
+    if conn is None:
+        try:
+            conn = await asyncio.open_unix_connection(socket_path(shard))
+        except Exception:
+            pool.put_nowait(None)
+            raise
+    return pool, conn
+
+
+async def call_shard(shard: int, request: dict) -> dict:
+    pool, (reader, writer) = await __connection(shard)
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError(f'shard {shard} closed connection')
+    except BaseException:
+        writer.close()
+        pool.put_nowait(None)
+        raise
+    pool.put_nowait((reader, writer))
+    return json.loads(line)
+
+
+async def call(ticker: str, request: dict) -> dict:
+    # Шлем команду владельцу тикера. Если тикер переехал, шард подскажет нового владельца
+    request['ticker'] = ticker
+    for _ in range(MATCHING_SHARDS + 1):
+        response = await call_shard(shard_for(ticker), request)
+        if 'moved' in response:
+            ASSIGNMENT[ticker] = response['moved']
+            continue
+        if 'error' in response:
+            raise HTTPException(response['error']['status'], response['error']['detail'])
+        return response
+    raise HTTPException(503, f'no shard accepts {ticker}')
+
+
+async def broadcast(request: dict):
+    return await asyncio.gather(*[call_shard(shard, dict(request)) for shard in range(MATCHING_SHARDS)])
+
+
+def begin_move(ticker: str, shard: int):
+    ASSIGNMENT[ticker] = shard
+    MOVING.setdefault(ticker, asyncio.Event())
+
+
+def end_move(ticker: str):
+    event = MOVING.pop(ticker, None)
+    if event is not None:
+        event.set()
+
+
+async def wait_moved(ticker: str):
+    event = MOVING.get(ticker)
+    if event is not None:
+        await event.wait()
+
+
+async def current_owner(ticker: str) -> int:
+    # ASSIGNMENT этого процесса мог устареть: при WORKERS > 1 тикер мог переназначить другой воркер.
+    # Владелец - шард, который считает тикер своим; двое таких бывает только посреди переезда
+    answers = await asyncio.gather(*[
+        call_shard(i, {'op': 'owner', 'ticker': ticker}) for i in range(MATCHING_SHARDS)
+    ])
+    owners = [i for i, answer in enumerate(answers) if answer['shard'] == i]
+    if len(owners) != 1:
+        raise HTTPException(409, f'{ticker} is being moved between shards')
+    ASSIGNMENT[ticker] = owners[0]
+    return owners[0]
+
+
+async def assign(ticker: str, shard: int):
+    # Первым узнает новый владелец и придерживает запросы по тикеру. Потом старый дожидается своих ордеров
+    # и выгружает стакан, его ответы moved уже ведут в новый шард, так что запросы не скачут между шардами.
+    # Только после этого новый владелец начинает исполнять, и тикер никогда не матчат два процесса сразу
+    old = await current_owner(ticker)
+    await call_shard(shard, {'op': 'assign', 'ticker': ticker, 'shard': shard, 'pending': True})
+    try:
+        if old != shard:
+            await call_shard(old, {'op': 'assign', 'ticker': ticker, 'shard': shard})
+    except BaseException:
+        # Старый владелец не отпустил тикер: возвращаем его, придержанные запросы уйдут к нему
+        await call_shard(shard, {'op': 'assign', 'ticker': ticker, 'shard': old})
+        raise
+    await call_shard(shard, {'op': 'assign', 'ticker': ticker, 'shard': shard})
+    await asyncio.gather(*[
+        call_shard(i, {'op': 'assign', 'ticker': ticker, 'shard': shard})
+        for i in range(MATCHING_SHARDS) if i not in (old, shard)
+    ])
+    ASSIGNMENT[ticker] = shard
+
+
+async def ping() -> list:
+    # Падает, если какой-то шард еще грузит стаканы (сокета нет) или умер
+    return await asyncio.gather(*[call_shard(shard, {'op': 'ping'}) for shard in range(MATCHING_SHARDS)])
+
+
+async def wait_ready():
+    deadline = time.monotonic() + SHARD_START_TIMEOUT
+    while True:
+        try:
+            return await ping()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def drop_books(ticker: Optional[str] = None):
+    if is_forwarding():
+        await broadcast({'op': 'drop', 'ticker': ticker})
+
+
+def order_to_dict(order: Order) -> dict:
+    return {
+        "id": str(order.id),
+        "user_id": str(order.user_id),
+        "instrument_ticker": order.instrument_ticker,
+        "amount": order.amount,
+        "filled": order.filled,
+        "price": order.price,
+        "direction": order.direction.name,
+        "status": order.status.name,
+        "created_at": order.created_at.isoformat() if order.created_at else None
+    }
+
+
+def order_from_dict(data: dict) -> Order:
+    return Order(
+        id=uuid.UUID(data['id']),
+        user_id=uuid.UUID(data['user_id']),
+        instrument_ticker=data['instrument_ticker'],
+        amount=data['amount'],
+        filled=data['filled'],
+        price=data['price'],
+        direction=DirectionEnum[data['direction']],
+        status=OrderStatusEnum[data['status']],
+        created_at=datetime.fromisoformat(data['created_at']) if data['created_at'] else None
+    )
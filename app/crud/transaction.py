@@ -1,17 +1,58 @@
-from typing import List
+import os
+from collections import deque
+from typing import Deque, Dict, List
 
 from sqlalchemy import select
 
+from crud import shards
+from crud.book import is_resident
+from crud.locks import acquire_locks, get_lock
 from database.database import async_session_maker
-from database.models import Transaction, Instrument
+from database.models import Transaction
 
+# Сколько последних сделок по тикеру держим в памяти
+TRADES_BUFFER_SIZE = int(os.getenv('TRADES_BUFFER_SIZE', 1000))
 
-async def get_transactions_by_ticker(ticker: str, limit: int = 10) -> List[Transaction]:
+# ticker -> последние сделки, новые справа. Тикера нет - буфер еще не прогрет из базы
+RECENT_TRADES: Dict[str, Deque[Transaction]] = dict()
+
+
+def is_buffered() -> bool:
+    # Сделки видны буферу, только если матчинг идет в этом процессе
+    return is_resident() and not shards.is_forwarding()
+
+
+def remember_trades(ticker: str, trades: List[Transaction]):
+    # Вызывается после коммита сделок. Непрогретый буфер не трогаем, он загрузится из базы целиком
+    buffer = RECENT_TRADES.get(ticker)
+    if buffer is not None:
+        buffer.extend(trades)
+
+
+def forget_trades(ticker: str):
+    RECENT_TRADES.pop(ticker, None)
+
+
+async def load_recent_trades(tickers: List[str]):
+    for ticker in tickers:
+        async with acquire_locks(get_lock(ticker)):
+            await __warm(ticker)
+
+
+async def __warm(ticker: str) -> Deque[Transaction]:
+    # Звать под локом тикера, чтобы новые сделки не проскочили между чтением и заполнением
+    buffer = RECENT_TRADES.get(ticker)
+    if buffer is None:
+        transactions = await __select_transactions(ticker, TRADES_BUFFER_SIZE)
+        buffer = RECENT_TRADES[ticker] = deque(reversed(transactions), maxlen=TRADES_BUFFER_SIZE)
+    return buffer
+
+
+async def __select_transactions(ticker: str, limit: int) -> List[Transaction]:
     async with async_session_maker() as session:
         stmt = (
             select(Transaction)
-            .join(Transaction.instrument)
-            .filter(Instrument.ticker == ticker)
+            .where(Transaction.instrument_ticker == ticker)
             .order_by(Transaction.timestamp.desc())
             .limit(limit)
         )
@@ -22,6 +63,17 @@ async def get_transactions_by_ticker(ticker: str, limit: int = 10) -> List[Trans
         return transactions
 
 
+async def get_transactions_by_ticker(ticker: str, limit: int = 10) -> List[Transaction]:
+    # Последние сделки, новые первыми. Из базы читаем только историю глубже буфера
+    if not is_buffered() or limit > TRADES_BUFFER_SIZE:
+        return await __select_transactions(ticker, limit)
+    buffer = RECENT_TRADES.get(ticker)
+    if buffer is None:
+        async with acquire_locks(get_lock(ticker)):
+            buffer = await __warm(ticker)
+    return [buffer[-i] for i in range(1, min(limit, len(buffer)) + 1)]
+
+
 async def create_transaction(user_from_id: str, user_to_id: str, ticker: str, amount: int, price: float) -> Transaction:
     async with async_session_maker() as session:
         t = await __create_transaction(session, user_from_id, user_to_id, ticker, amount, price)
@@ -1,30 +1,35 @@
 import asyncio
 import os
 import uuid
-from typing import Optional, List
+from datetime import datetime
+from typing import Optional, List, Tuple
 
 from fastapi import HTTPException
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, text, tuple_
 
-from crud.locks import acquire_locks, LOCKS
-from database.models import User, RoleEnum, Instrument, UserInventory, Order
+from core.cache import TTLCache
+from core.journal import JOURNAL
+from crud.inventory import get_or_create_inventory
+from database.models import User, RoleEnum, UserInventory, Order, OrderStatusEnum, DirectionEnum
 from database.database import async_session_maker
 
+# Проверенный токен -> пользователь, чтобы не ходить в базу на каждый запрос
+TOKEN_CACHE = TTLCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('TOKEN_CACHE_TTL', 60))
+)
+# Пользователи, которых сейчас удаляют
+DELETING_USERS = set()
+
 
 async def create_user(name: str, role: RoleEnum=RoleEnum.USER) -> User:
     async with async_session_maker() as session:
         new_user = User(name=name, role=role)
         session.add(new_user)
-
-        result = await session.execute(select(Instrument))
-        instruments = result.scalars().all()
-        for instrument in instruments:
-            inv = UserInventory(user=new_user, instrument=instrument, quantity=0.0)
-            session.add(inv)
-
+        # Инвентарь заводится лениво при первом зачислении инструмента
         await session.commit()
         await session.refresh(new_user)
+        JOURNAL.record('user', user_id=new_user.id, name=new_user.name, role=new_user.role.name)
         return new_user
 
 
@@ -44,24 +49,102 @@ async def apply_api_key(uuid_str: str, key:str):
         return user
 
 async def delete_user(uuid_str: str) -> Optional[User]:
-    async with acquire_locks(*LOCKS.values()):
+    from crud.order import cancel_user_orders
+
+    user = await get_user(uuid_str)
+    if not user:
+        raise HTTPException(status_code=404, detail='Пользователь с таким id не найден')
+    # Новые запросы пользователя больше не авторизуются
+    DELETING_USERS.add(user.id)
+    invalidate_user_tokens(user.id)
+    try:
+        # Вместо лока на всю биржу снимаем ордера под локом каждого тикера по очереди
+        await cancel_user_orders(user.id)
         async with async_session_maker() as session:
-            user = await get_user(uuid_str)
-            if not user:
-                raise HTTPException(status_code=404, detail='Пользователь с таким id не найден')
             await session.delete(user)
             await session.commit()
+            JOURNAL.record('delete_user', user_id=user.id)
             #await asyncio.sleep(1)
             return user
+    finally:
+        DELETING_USERS.discard(user.id)
+
+def invalidate_user_tokens(user_id: [uuid.UUID, str]):
+    user_id = uuid.UUID(str(user_id))
+    TOKEN_CACHE.invalidate(lambda user: user.id == user_id)
+
 
 async def change_balance(id: [uuid.UUID, str], ticker: str, amount: int) -> Optional[User]:
     async with async_session_maker() as session:
         b = await __change_balance(session, id, ticker, amount)
         await session.commit()
+        JOURNAL.record('balance', user_id=id, ticker=ticker, amount=amount)
         await session.refresh(b)
         return b
 
 
+async def change_balances(entries: List[Tuple[uuid.UUID, str, int]]) -> List[Optional[str]]:
+    # Пакетное пополнение/списание одной транзакцией. Для каждой записи None или текст ошибки.
+    # Строки блокируем и читаем одним запросом на таблицу, записи проверяем по порядку на этом снимке,
+    # а изменения применяем суммарными дельтами через unnest - по одному UPDATE на таблицу
+    rub = os.getenv('BASE_INSTRUMENT_TICKER')
+    user_ids = sorted({user_id for user_id, _, _ in entries})
+    pairs = sorted({(user_id, ticker) for user_id, ticker, _ in entries if ticker != rub})
+    async with async_session_maker() as session:
+        balances = dict((await session.execute(
+            select(User.id, User.balance).where(User.id.in_(user_ids)).order_by(User.id).with_for_update()
+        )).all())
+        quantities = dict()
+        if pairs:
+            rows = await session.execute(
+                select(UserInventory.user_id, UserInventory.instrument_ticker, UserInventory.quantity)
+                .where(tuple_(UserInventory.user_id, UserInventory.instrument_ticker).in_(pairs))
+                .order_by(UserInventory.id).with_for_update()
+            )
+            quantities = {(user_id, ticker): quantity for user_id, ticker, quantity in rows}
+
+        result = []
+        user_deltas, inventory_deltas = dict(), dict()
+        for user_id, ticker, amount in entries:
+            if user_id not in balances:
+                result.append('User not found')
+                continue
+            current, deltas, key = (balances, user_deltas, user_id) if ticker == rub \
+                else (quantities, inventory_deltas, (user_id, ticker))
+            current.setdefault(key, 0)
+            if current[key] + amount < 0:
+                result.append('Balance must be >= 0')
+                continue
+            current[key] += amount
+            deltas[key] = deltas.get(key, 0) + amount
+            result.append(None)
+
+        if user_deltas:
+            await session.execute(text(
+                'UPDATE users SET balance = users.balance + d.delta '
+                'FROM unnest(CAST(:ids AS uuid[]), CAST(:deltas AS float8[])) AS d(id, delta) '
+                'WHERE users.id = d.id'
+            ), {'ids': list(user_deltas), 'deltas': [float(d) for d in user_deltas.values()]})
+        if inventory_deltas:
+            # Недостающие строки инвентаря создаем тем же запросом
+            await session.execute(text(
+                'INSERT INTO user_inventories (id, user_id, instrument_ticker, quantity, frozen) '
+                'SELECT d.id, d.user_id, d.ticker, d.delta, 0 '
+                'FROM unnest(CAST(:row_ids AS uuid[]), CAST(:ids AS uuid[]), CAST(:tickers AS varchar[]), '
+                'CAST(:deltas AS float8[])) AS d(id, user_id, ticker, delta) '
+                'ON CONFLICT (user_id, instrument_ticker) '
+                'DO UPDATE SET quantity = user_inventories.quantity + excluded.quantity'
+            ), {'row_ids': [uuid.uuid4() for _ in inventory_deltas],
+                'ids': [user_id for user_id, _ in inventory_deltas],
+                'tickers': [ticker for _, ticker in inventory_deltas],
+                'deltas': [float(d) for d in inventory_deltas.values()]})
+        await session.commit()
+        for (user_id, ticker, amount), error in zip(entries, result):
+            if error is None:
+                JOURNAL.record('balance', user_id=user_id, ticker=ticker, amount=amount)
+        return result
+
+
 async def __change_balance(session, id: [uuid.UUID, str], ticker: str, amount: int) -> Optional[User]:
     id = str(id)
     if ticker == os.getenv('BASE_INSTRUMENT_TICKER'):
@@ -74,18 +157,13 @@ async def __change_balance(session, id: [uuid.UUID, str], ticker: str, amount: i
         user.balance = new_balance
         session.add(user)
     else:
-        result = await session.execute(
-            select(User).where(User.id == uuid.UUID(id)).options(selectinload(User.inventory))
-        )
-        user = result.scalar_one_or_none()
-        for inv in user.inventory:
-            if inv.instrument_ticker == ticker:
-                new_balance = inv.quantity + amount
-                if new_balance < 0:
-                    raise HTTPException(status_code=400, detail='Balance must be >= 0')
-                inv.quantity = new_balance
-                session.add(inv)
-                break
+        user = await session.get(User, uuid.UUID(id))
+        inv = await get_or_create_inventory(session, user.id, ticker)
+        new_balance = inv.quantity + amount
+        if new_balance < 0:
+            raise HTTPException(status_code=400, detail='Balance must be >= 0')
+        inv.quantity = new_balance
+        session.add(inv)
 
     #await session.commit()
     return user
@@ -93,10 +171,24 @@ async def __change_balance(session, id: [uuid.UUID, str], ticker: str, amount: i
 
 
 
-async def get_user_orders(uuid_str: str) -> List[Order]:
+async def get_user_orders(uuid_str: str, limit: Optional[int] = None, after: Optional[Tuple[datetime, uuid.UUID]] = None,
+                          status: Optional[OrderStatusEnum] = None, ticker: Optional[str] = None,
+                          direction: Optional[DirectionEnum] = None) -> List[Order]:
+    # Ордера пользователя от новых к старым по (created_at, id), after - ключ последнего ордера предыдущей страницы.
+    # Идет по ix_orders_user_created (или по индексу со статусом/тикером) в обратную сторону
+    q = select(Order).where(Order.user_id == uuid.UUID(uuid_str))
+    if after is not None:
+        q = q.where(tuple_(Order.created_at, Order.id) < tuple_(*after))
+    if status is not None:
+        q = q.where(Order.status == status)
+    if ticker is not None:
+        q = q.where(Order.instrument_ticker == ticker)
+    if direction is not None:
+        q = q.where(Order.direction == direction)
+    q = q.order_by(Order.created_at.desc(), Order.id.desc())
+    if limit is not None:
+        q = q.limit(limit)
     async with async_session_maker() as session:
-        result = await session.execute(
-            select(Order).where(Order.user_id == uuid.UUID(uuid_str))
-        )
+        result = await session.execute(q)
         orders = result.scalars().all()
         return orders
@@ -1,6 +1,11 @@
+import time
+
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
+
+from core.metrics import POOL_WAIT
 from dotenv import load_dotenv
 # load_dotenv(".env")
 postgres_user = os.getenv("POSTGRES_USER")
@@ -10,9 +15,22 @@ postgres_port = os.getenv("POSTGRES_PORT")
 postgres_db = os.getenv("POSTGRES_DB")
 DATABASE_URL = f'postgresql+asyncpg://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}'
 print(DATABASE_URL)
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    # Сколько ждали свободное соединение из пула
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
+
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,
+    poolclass=TimedPool,
     pool_size=10,
     max_overflow=15,
     pool_recycle=1800,
@@ -21,4 +39,16 @@ engine = create_async_engine(
 )
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
+# Отдельный пул под advisory-локи тикеров (LOCK_BACKEND=postgres): соединение держится, пока лок захвачен,
+# и не должно отнимать соединения у сессий, которые работают под этим локом
+lock_engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=int(os.getenv('LOCK_POOL_SIZE', 10)),
+    max_overflow=int(os.getenv('LOCK_POOL_OVERFLOW', 10)),
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    pool_timeout=30
+)
+
 Base = declarative_base()
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 from database.database import Base
 from datetime import datetime
@@ -28,6 +28,8 @@ class User(Base):
     name = Column(String, unique=False, nullable=False)
     role = Column(Enum(RoleEnum), default=RoleEnum.USER)
     balance = Column(Float, default=0.0)
+    # Заморожено под открытые ордера на покупку, в balance не входит
+    frozen_balance = Column(Float, nullable=False, default=0.0, server_default='0')
     api_key = Column(String, unique=False, nullable=True)
     # Создаем отношения
     orders = relationship("Order", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
@@ -42,11 +44,17 @@ class UserInventory(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
     instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), nullable=False)
     quantity = Column(Float, nullable=False, default=0.0)
+    # Заморожено под открытые ордера на продажу, в quantity не входит
+    frozen = Column(Float, nullable=False, default=0.0, server_default='0')
 
     # Создаем отношения
     user = relationship("User", back_populates="inventory")
     instrument = relationship("Instrument")
 
+    __table_args__ = (
+        UniqueConstraint('user_id', 'instrument_ticker', name='uq_user_inventories_user_ticker'),
+    )
+
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -65,6 +73,19 @@ class Order(Base):
     user = relationship("User", back_populates="orders")
     instrument = relationship("Instrument")
 
+    # Частичные индексы только по открытым ордерам, в порядке обхода стакана
+    __table_args__ = (
+        Index('ix_orders_open_asks', instrument_ticker, price, created_at, id,
+              postgresql_where=text("status IN ('NEW', 'PARTIALLY_EXECUTED') AND direction = 'ASK'")),
+        Index('ix_orders_open_bids', instrument_ticker, price.desc(), created_at, id,
+              postgresql_where=text("status IN ('NEW', 'PARTIALLY_EXECUTED') AND direction = 'BID'")),
+        Index('ix_orders_user_created', user_id, created_at, id),
+        # История с фильтром по статусу (открытые ордера бота) не должна пробегать все исполненные
+        Index('ix_orders_user_status_created', user_id, status, created_at, id),
+        # То же для фильтра по тикеру: редкий тикер у пользователя с большой историей
+        Index('ix_orders_user_ticker_created', user_id, instrument_ticker, created_at, id),
+    )
+
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -82,6 +103,13 @@ class Transaction(Base):
     user_to = relationship("User", foreign_keys=[user_to_id], back_populates="transactions_received")
     instrument = relationship("Instrument")
 
+    __table_args__ = (
+        Index('ix_transactions_ticker_timestamp', instrument_ticker, timestamp),
+        # Нужны для ON DELETE SET NULL при удалении пользователя
+        Index('ix_transactions_user_from', user_from_id),
+        Index('ix_transactions_user_to', user_to_id),
+    )
+
 
 class Instrument(Base):
     __tablename__ = 'instruments'
@@ -93,3 +121,17 @@ class Instrument(Base):
     inventories = relationship("UserInventory", back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
     orders = relationship("Order", back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
     transactions = relationship("Transaction", back_populates="instrument")
+
+
+class Candle(Base):
+    # Свечи по сделкам, обновляются в той же транзакции, что и сами сделки
+    __tablename__ = 'candles'
+
+    instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), primary_key=True)
+    interval = Column(String(3), primary_key=True)
+    start = Column(DateTime, primary_key=True)
+    open = Column(Float, nullable=False)
+    high = Column(Float, nullable=False)
+    low = Column(Float, nullable=False)
+    close = Column(Float, nullable=False)
+    volume = Column(Float, nullable=False, default=0.0)
@@ -2,16 +2,16 @@ import uuid
 
 from fastapi import HTTPException
 
-from crud.instrument import get_instrument_by_ticker
+from crud.instrument import get_instrument_name
 from crud.user import get_user
 from database.models import Instrument, User
 
 
 async def get_instrument_depend(ticker: str) -> Instrument:
-    instrument = await get_instrument_by_ticker(ticker)
-    if not instrument:
+    name = await get_instrument_name(ticker)
+    if name is None:
         raise HTTPException(404)
-    return instrument
+    return Instrument(ticker=ticker, name=name)
 
 async def get_user_depend(user_id: uuid.UUID) -> User:
     user_id = str(user_id)
@@ -1,4 +1,5 @@
 import logging
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -6,12 +7,93 @@ from starlette.requests import Request
 
 load_dotenv('.env')
 
+import multiprocessing
+import os
+
+# Несколько воркеров uvicorn: локи тикеров через Postgres, стакан читаем из базы, а не из памяти процесса
+WORKERS = int(os.getenv('WORKERS', 1))
+if WORKERS > 1:
+    if os.getenv('LOCK_BACKEND', 'postgres') != 'postgres' or os.getenv('MATCHING_ENGINE', 'sql') != 'sql':
+        raise SystemExit('WORKERS > 1 requires LOCK_BACKEND=postgres and MATCHING_ENGINE=sql')
+    os.environ['LOCK_BACKEND'] = 'postgres'
+    os.environ['MATCHING_ENGINE'] = 'sql'
+    # Удаление пользователя чистит кэш токенов только своего процесса, в остальных токен живет до конца TTL
+    os.environ.setdefault('TOKEN_CACHE_TTL', '1')
+# Журнал пишет один файл с одной нумерацией, несколько процессов перемешали бы записи и seq
+if os.getenv('JOURNAL_PATH') and (WORKERS > 1 or int(os.getenv('MATCHING_SHARDS', 0)) > 0):
+    raise SystemExit('JOURNAL_PATH requires WORKERS=1 and MATCHING_SHARDS=0')
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
+from core.metrics import MetricsMiddleware, Gauge, register, render
+from crud.user import TOKEN_CACHE
 from api.router import router
+from crud.instrument import load_instruments, get_registered_instruments
+from crud.transaction import load_recent_trades, is_buffered
+from crud.book import LOAD_STATS, is_resident, is_ready, load_books
+from crud import shards
+from crud.shards import MATCHING_SHARDS, is_forwarding
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await load_instruments()
+    if is_buffered():
+        await load_recent_trades(list(await get_registered_instruments()))
+    # Стаканы поднимаем до приема запросов: uvicorn не откроет порт, пока lifespan не дошел до yield.
+    # При шардах стаканы грузят они сами, HTTP-процесс ждет, пока все шарды откроют сокеты
+    if is_forwarding():
+        await shards.wait_ready()
+    elif is_resident():
+        await load_books(list(await get_registered_instruments()))
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(router, prefix='/api')
-uvicorn.run(app, host="0.0.0.0", port=8000)
+app.add_middleware(MetricsMiddleware)
+
+register(Gauge('token_cache_size', 'Entries in the API token cache', lambda: len(TOKEN_CACHE)))
+register(Gauge('token_cache_hits', 'API token cache hits', lambda: TOKEN_CACHE.hits))
+register(Gauge('token_cache_misses', 'API token cache misses', lambda: TOKEN_CACHE.misses))
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    # Метрики этого процесса. При WORKERS > 1 и в шардах у каждого процесса свои
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/ready', include_in_schema=False)
+async def ready():
+    if is_forwarding():
+        # Шард отвечает только после загрузки своих стаканов; упавший шард тоже делает сервис неготовым
+        try:
+            return {"ready": True, "books": [response['books'] for response in await shards.ping()]}
+        except OSError as e:
+            return JSONResponse({"ready": False, "detail": str(e)}, status_code=503)
+    if is_ready():
+        return {"ready": True, "books": LOAD_STATS}
+    return JSONResponse({"ready": False}, status_code=503)
+
+
+def start_shards():
+    # Процессы матчинга, HTTP-воркеры пересылают им ордера по тикерам
+    import shard
+    ctx = multiprocessing.get_context('spawn')
+    processes = [ctx.Process(target=shard.main, args=(i,), daemon=True) for i in range(MATCHING_SHARDS)]
+    for p in processes:
+        p.start()
+    return processes
+
+
+if __name__ == '__main__':
+    shard_processes = start_shards()
+    if WORKERS > 1:
+        uvicorn.run('main:app', host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,125 @@
+# Процесс матчинга: владеет частью тикеров, держит их стаканы в памяти и принимает команды
+# от HTTP-воркеров по unix-сокету (одна JSON-строка на запрос и на ответ).
+# Запускается из main.py при MATCHING_SHARDS > 0 или вручную: python shard.py <номер>
+import asyncio
+import json
+import os
+import sys
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from fastapi import HTTPException
+
+import crud.book
+import crud.locks
+from crud import shards
+from crud.book import LOAD_STATS, drop_book, drop_all_books, load_books
+from crud.instrument import get_registered_instruments
+from crud.locks import acquire_locks, get_lock
+from crud.order import create_limit_buy_order, create_limit_sell_order, cancel_order, get_orderbook, \
+    create_orders_batch, cancel_user_orders
+from database.models import User, DirectionEnum
+
+
+async def handle(request: dict) -> dict:
+    op = request['op']
+    ticker = request.get('ticker')
+
+    if op == 'ping':
+        # Сокет открывается только после загрузки стаканов, так что ответ уже означает готовность
+        return {'books': LOAD_STATS}
+
+    if op == 'owner':
+        # Шарды узнают о каждом переназначении, поэтому владельца спрашивают у них, а не у HTTP-воркера
+        return {'shard': shards.shard_for(ticker)}
+
+    if op == 'drop':
+        if ticker is None:
+            drop_all_books()
+        else:
+            drop_book(ticker)
+        return {}
+
+    if op == 'assign':
+        if request.get('pending'):
+            # Тикер переезжает сюда, но старый владелец еще не выгрузил стакан
+            shards.begin_move(ticker, request['shard'])
+            return {}
+        # Дожидаемся ордеров, которые уже исполняются по тикеру, и выгружаем его стакан
+        async with acquire_locks(get_lock(ticker)):
+            shards.ASSIGNMENT[ticker] = request['shard']
+            if request['shard'] != shards.SHARD_INDEX:
+                drop_book(ticker)
+        shards.end_move(ticker)
+        return {}
+
+    await shards.wait_moved(ticker)
+    owner = shards.shard_for(ticker)
+    if owner != shards.SHARD_INDEX:
+        return {'moved': owner}
+
+    if op == 'depth':
+        tag, depth = await get_orderbook(ticker, request['limit'])
+        return {'tag': tag, 'depth': depth}
+
+    if op not in ('order', 'cancel', 'batch', 'cancel_user'):
+        raise HTTPException(400, f'unknown op {op}')
+    user = User(id=uuid.UUID(request['user_id']))
+    if op == 'order':
+        create = create_limit_buy_order if request['direction'] == DirectionEnum.BID.name else create_limit_sell_order
+        order = await create(ticker, request['qty'], request['price'], user)
+        return {'order': shards.order_to_dict(order)}
+    if op == 'cancel':
+        order = await cancel_order(request['order_id'], user.id)
+        return {'order': shards.order_to_dict(order) if order else None}
+    if op == 'cancel_user':
+        await cancel_user_orders(user.id, ticker)
+        return {}
+    if op == 'batch':
+        orders = [(DirectionEnum[d], t, qty, price) for d, t, qty, price in request['orders']]
+        return {'orders': [shards.order_to_dict(o) for o in await create_orders_batch(orders, user)]}
+
+
+async def serve_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while line := await reader.readline():
+            try:
+                response = await handle(json.loads(line))
+            except HTTPException as e:
+                response = {'error': {'status': e.status_code, 'detail': e.detail}}
+            except Exception as e:
+                print(e)
+                response = {'error': {'status': 500, 'detail': str(e)}}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(index: int):
+    # Тикер принадлежит ровно одному процессу, поэтому хватает локов и стакана внутри процесса
+    crud.book.MATCHING_ENGINE = 'memory'
+    crud.locks.LOCK_BACKEND = 'local'
+    shards.SHARD_INDEX = index
+    # Сокет появляется только после загрузки своих стаканов, до этого HTTP-воркеры получают отказ соединения
+    tickers = [ticker for ticker in await get_registered_instruments() if shards.shard_for(ticker) == index]
+    stats = await load_books(tickers)
+    print(f'shard {index} loaded {stats["orders"]} open orders of {stats["tickers"]} tickers in {stats["seconds"]}s')
+    path = shards.socket_path(index)
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(serve_connection, path=path)
+    print(f'shard {index}/{shards.MATCHING_SHARDS} listening on {path}')
+    async with server:
+        await server.serve_forever()
+
+
+def main(index: int):
+    asyncio.run(serve(index))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]))
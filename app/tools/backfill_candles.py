@@ -0,0 +1,71 @@
+# Пересчитывает таблицу свечей по уже записанным сделкам.
+# Нужен один раз после миграции, добавившей candles, или чтобы починить историю.
+# Считает в базе: по тикеру, окнами в несколько суток, все интервалы одним INSERT ... SELECT на окно.
+# Свечи окна перезаписываются целиком, поэтому запускать при остановленном сервисе:
+# python -m tools.backfill_candles --days 7
+import argparse
+import asyncio
+import time
+from datetime import timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import text
+
+from crud.candle import INTERVALS, bucket
+from database.database import engine
+
+# date_bin отсчитывает корзины от origin, берем ту же эпоху, что и crud.candle.bucket
+BACKFILL = """
+INSERT INTO candles (instrument_ticker, "interval", start, open, high, low, close, volume)
+SELECT t.instrument_ticker, i."interval", date_bin(i.step, t.timestamp, TIMESTAMP '1970-01-01') AS start,
+       (array_agg(t.price ORDER BY t.timestamp, t.id))[1],
+       MAX(t.price), MIN(t.price),
+       (array_agg(t.price ORDER BY t.timestamp DESC, t.id DESC))[1],
+       SUM(t.amount)
+FROM transactions t
+CROSS JOIN (VALUES {intervals}) AS i("interval", step)
+WHERE t.instrument_ticker = :ticker AND t.timestamp >= :start AND t.timestamp < :end AND t.price IS NOT NULL
+GROUP BY t.instrument_ticker, i."interval", 3
+ON CONFLICT (instrument_ticker, "interval", start) DO UPDATE SET
+    open = excluded.open, high = excluded.high, low = excluded.low,
+    close = excluded.close, volume = excluded.volume
+""".format(intervals=', '.join(f"('{name}', INTERVAL '{int(step.total_seconds())} seconds')"
+                               for name, step in INTERVALS.items()))
+
+
+async def backfill(days: int):
+    async with engine.connect() as conn:
+        tickers = (await conn.execute(text(
+            'SELECT DISTINCT instrument_ticker FROM transactions WHERE instrument_ticker IS NOT NULL'))).scalars().all()
+    step = timedelta(days=days)
+    for ticker in tickers:
+        started = time.perf_counter()
+        async with engine.connect() as conn:
+            first, last = (await conn.execute(text(
+                'SELECT MIN(timestamp), MAX(timestamp) FROM transactions WHERE instrument_ticker = :ticker'),
+                {'ticker': ticker})).one()
+        if first is None:
+            continue
+        # Окна выровнены по суткам, так что ни одна свеча не делится между двумя окнами
+        start, rows = bucket(first, '1d'), 0
+        while start <= last:
+            async with engine.begin() as conn:
+                rows += (await conn.execute(text(BACKFILL),
+                                            {'ticker': ticker, 'start': start, 'end': start + step})).rowcount
+            start += step
+        print(f'{ticker}: {rows} candles in {time.perf_counter() - started:.2f}s')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=7, help='размер окна в сутках')
+    args = parser.parse_args()
+    await backfill(args.days)
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# Заполняет users.frozen_balance и user_inventories.frozen по уже открытым ордерам.
+# Нужен один раз после миграции, добавившей эти колонки: раньше заморозка хранилась только в самих ордерах.
+# Запускать из папки app при остановленном сервисе: python -m tools.backfill_frozen
+# С --check ничего не пишет, а сверяет колонки с открытыми ордерами (например, после удаления тикеров)
+import argparse
+import asyncio
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import text
+
+from database.database import engine
+
+OPEN = "('NEW', 'PARTIALLY_EXECUTED')"
+
+RESET_USERS = "UPDATE users SET frozen_balance = 0 WHERE frozen_balance <> 0"
+RESET_INVENTORIES = "UPDATE user_inventories SET frozen = 0 WHERE frozen <> 0"
+
+# Ордер на покупку держит amount * price рублей, на продажу - amount инструмента
+FILL_USERS = f"""
+UPDATE users SET frozen_balance = o.frozen
+FROM (
+    SELECT user_id, SUM(amount * price) AS frozen FROM orders
+    WHERE direction = 'BID' AND status IN {OPEN} AND price IS NOT NULL
+    GROUP BY user_id
+) o
+WHERE users.id = o.user_id
+"""
+FILL_INVENTORIES = f"""
+UPDATE user_inventories SET frozen = o.frozen
+FROM (
+    SELECT user_id, instrument_ticker, SUM(amount) AS frozen FROM orders
+    WHERE direction = 'ASK' AND status IN {OPEN} AND price IS NOT NULL
+    GROUP BY user_id, instrument_ticker
+) o
+WHERE user_inventories.user_id = o.user_id AND user_inventories.instrument_ticker = o.instrument_ticker
+"""
+
+
+# Расхождения замороженного с открытыми ордерами, в том числе у тех, у кого открытых ордеров нет вовсе
+CHECK_USERS = f"""
+SELECT users.id, users.frozen_balance, COALESCE(o.frozen, 0) FROM users
+LEFT JOIN (
+    SELECT user_id, SUM(amount * price) AS frozen FROM orders
+    WHERE direction = 'BID' AND status IN {OPEN} AND price IS NOT NULL
+    GROUP BY user_id
+) o ON o.user_id = users.id
+WHERE users.frozen_balance <> COALESCE(o.frozen, 0)
+"""
+CHECK_INVENTORIES = f"""
+SELECT i.user_id, i.instrument_ticker, i.frozen, COALESCE(o.frozen, 0) FROM user_inventories i
+LEFT JOIN (
+    SELECT user_id, instrument_ticker, SUM(amount) AS frozen FROM orders
+    WHERE direction = 'ASK' AND status IN {OPEN} AND price IS NOT NULL
+    GROUP BY user_id, instrument_ticker
+) o ON o.user_id = i.user_id AND o.instrument_ticker = i.instrument_ticker
+WHERE i.frozen <> COALESCE(o.frozen, 0)
+"""
+
+
+async def check() -> bool:
+    async with engine.connect() as conn:
+        users = (await conn.execute(text(CHECK_USERS))).all()
+        inventories = (await conn.execute(text(CHECK_INVENTORIES))).all()
+    await engine.dispose()
+    for user_id, frozen, expected in users:
+        print(f'user {user_id}: frozen_balance {frozen}, open bids hold {expected}')
+    for user_id, ticker, frozen, expected in inventories:
+        print(f'user {user_id} {ticker}: frozen {frozen}, open asks hold {expected}')
+    print(f'mismatched users: {len(users)}, inventories: {len(inventories)}')
+    return not users and not inventories
+
+
+async def main():
+    async with engine.begin() as conn:
+        for statement in (RESET_USERS, RESET_INVENTORIES):
+            await conn.execute(text(statement))
+        users = (await conn.execute(text(FILL_USERS))).rowcount
+        inventories = (await conn.execute(text(FILL_INVENTORIES))).rowcount
+    await engine.dispose()
+    print(f'users: {users}, inventories: {inventories}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true')
+    if parser.parse_args().check:
+        sys.exit(0 if asyncio.run(check()) else 1)
+    asyncio.run(main())
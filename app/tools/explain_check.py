@@ -0,0 +1,178 @@
+# Проверка планов горячих запросов: засеваем локальную базу, прогоняем горячие функции из crud,
+# перехватываем их SQL и делаем EXPLAIN. Если где-то Seq Scan по большой таблице или запрос не взял
+# ожидаемый для него индекс - выходим с ошибкой.
+# Запуск из папки app против одноразовой базы: python -m tools.explain_check --orders 100000
+import argparse
+import asyncio
+import json
+import random
+import sys
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import event, insert, select, text
+
+import crud.book
+from crud.inventory import get_user_inventory, get_user_balances
+from crud.order import get_orderbook, create_limit_buy_order, create_limit_sell_order
+from crud.transaction import get_transactions_by_ticker
+from crud.user import get_user_orders, get_user
+from database.database import engine, Base
+from database.models import User, Instrument, UserInventory, Order, Transaction, DirectionEnum, OrderStatusEnum
+
+TICKER = 'QPLAN'
+HOT_TABLES = {'orders', 'transactions', 'user_inventories', 'users'}
+# Запросы, для которых мало отсутствия Seq Scan: обход чужого индекса с фильтром тоже пробегает всю историю
+EXPECTED_INDEXES = {
+    'user_orders_ticker': 'ix_orders_user_ticker_created',
+}
+
+
+@contextmanager
+def capture_sql():
+    captured = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', listener)
+    try:
+        yield captured
+    finally:
+        event.remove(engine.sync_engine, 'before_cursor_execute', listener)
+
+
+async def seed(users: int, orders: int, transactions: int):
+    rnd = random.Random(0)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        if await conn.scalar(select(Instrument.ticker).where(Instrument.ticker == TICKER)):
+            return
+        tickers = [TICKER] + [f'QP{i}' for i in range(4)]
+        await conn.execute(insert(Instrument), [{'ticker': t, 'name': t} for t in tickers])
+        user_ids = [uuid.uuid4() for _ in range(users)]
+        await conn.execute(insert(User), [{'id': u, 'name': 'seed', 'balance': 10 ** 9} for u in user_ids])
+        await conn.execute(insert(UserInventory), [
+            {'id': uuid.uuid4(), 'user_id': u, 'instrument_ticker': t, 'quantity': 10 ** 6}
+            for u in user_ids for t in tickers
+        ])
+
+        start = datetime.utcnow() - timedelta(days=30)
+        rows = []
+        for i in range(orders):
+            direction = rnd.choice([DirectionEnum.BID, DirectionEnum.ASK])
+            status = OrderStatusEnum.NEW if rnd.random() < 0.05 else OrderStatusEnum.EXECUTED
+            price = rnd.randint(50, 99) if direction == DirectionEnum.BID else rnd.randint(101, 150)
+            rows.append({
+                'id': uuid.uuid4(), 'user_id': rnd.choice(user_ids), 'instrument_ticker': rnd.choice(tickers),
+                'amount': 10, 'filled': 0, 'price': price, 'direction': direction, 'status': status,
+                'created_at': start + timedelta(seconds=i)
+            })
+            if len(rows) == 10000:
+                await conn.execute(insert(Order), rows)
+                rows = []
+        if rows:
+            await conn.execute(insert(Order), rows)
+
+        rows = []
+        for i in range(transactions):
+            rows.append({
+                'id': uuid.uuid4(), 'user_from_id': rnd.choice(user_ids), 'user_to_id': rnd.choice(user_ids),
+                'instrument_ticker': rnd.choice(tickers), 'amount': 1, 'price': 100,
+                'timestamp': start + timedelta(seconds=i)
+            })
+            if len(rows) == 10000:
+                await conn.execute(insert(Transaction), rows)
+                rows = []
+        if rows:
+            await conn.execute(insert(Transaction), rows)
+
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.execute(text('ANALYZE'))
+
+
+def seq_scans(plan: dict) -> list:
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in HOT_TABLES:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def indexes(plan: dict) -> set:
+    found = {plan['Index Name']} if 'Index Name' in plan else set()
+    for child in plan.get('Plans', []):
+        found |= indexes(child)
+    return found
+
+
+async def hot_paths():
+    async with engine.connect() as conn:
+        user_id = (await conn.execute(text('SELECT user_id FROM orders LIMIT 1'))).scalar()
+    user = await get_user(str(user_id))
+
+    paths = dict()
+    crud.book.MATCHING_ENGINE = 'sql'
+    with capture_sql() as sql:
+        await get_orderbook(TICKER)
+    paths['orderbook'] = sql
+    with capture_sql() as sql:
+        await create_limit_buy_order(TICKER, 1, 200, user)
+        await create_limit_sell_order(TICKER, 1, 1, user)
+    paths['matching'] = sql
+    with capture_sql() as sql:
+        await get_transactions_by_ticker(TICKER, 10)
+    paths['transactions'] = sql
+    with capture_sql() as sql:
+        await get_user_inventory(user.id, TICKER)
+    paths['inventory'] = sql
+    with capture_sql() as sql:
+        await get_user_balances(user.id)
+    paths['balance'] = sql
+    with capture_sql() as sql:
+        await get_user_orders(str(user.id), 101)
+        await get_user_orders(str(user.id), 101, status=OrderStatusEnum.NEW)
+    paths['user_orders'] = sql
+    with capture_sql() as sql:
+        # Редкий для пользователя тикер: без своего индекса запрос читает всю его историю
+        await get_user_orders(str(user.id), 101, ticker='QP3')
+    paths['user_orders_ticker'] = sql
+    return paths
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--transactions', type=int, default=100000)
+    args = parser.parse_args()
+
+    await seed(args.users, args.orders, args.transactions)
+    failed = False
+    for name, statements in (await hot_paths()).items():
+        for statement, parameters in statements:
+            async with engine.connect() as conn:
+                result = await conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+                plan = result.scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            scans = seq_scans(plan[0]['Plan'])
+            expected = EXPECTED_INDEXES.get(name)
+            missing = expected is not None and expected not in indexes(plan[0]['Plan'])
+            status = 'SEQ SCAN ' + ', '.join(scans) if scans else f'NO {expected}' if missing else 'ok'
+            print(f'[{name}] {status}: {" ".join(statement.split())[:120]}')
+            failed = failed or bool(scans) or missing
+    await engine.dispose()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
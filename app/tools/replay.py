@@ -0,0 +1,165 @@
+# Воспроизведение журнала команд (JOURNAL_PATH) через crud/order.py на одноразовой базе.
+# Каждый прогон начинается с пустых таблиц. Сравниваются итоги ордеров с записанными в журнале,
+# а лента сделок и итоговые балансы - между прогонами (должны совпасть до бита).
+# Запуск из папки app: python -m tools.replay journal.ndjson --runs 2 --wipe
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv('.env')
+
+from sqlalchemy import insert, select, text
+
+import core.journal
+import crud.book
+from core.journal import read_journal
+from crud.instrument import INSTRUMENTS, create_instrument, delete_instrument, load_instruments
+from crud.order import create_limit_buy_order, create_limit_sell_order, cancel_order, delete_all_orders
+from crud.transaction import RECENT_TRADES
+from crud.user import TOKEN_CACHE, change_balance, delete_user
+from database.database import engine, Base
+from database.models import User, RoleEnum, Order, Transaction, UserInventory
+
+TABLES = 'transactions, candles, orders, user_inventories, users, instruments'
+
+
+async def reset():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text(f'TRUNCATE {TABLES} CASCADE'))
+    crud.book.drop_all_books()
+    INSTRUMENTS.clear()
+    RECENT_TRADES.clear()
+    TOKEN_CACHE.clear()
+    await load_instruments()
+
+
+async def apply(entry: dict, order_ids: dict, mismatches: list):
+    op = entry['op']
+    if op == 'user':
+        async with engine.begin() as conn:
+            await conn.execute(insert(User).values(id=uuid.UUID(entry['user_id']), name=entry['name'],
+                                                   role=RoleEnum[entry['role']]))
+    elif op == 'instrument':
+        await create_instrument(entry['name'], entry['ticker'])
+    elif op == 'delete_instrument':
+        await delete_instrument(entry['ticker'])
+    elif op == 'balance':
+        await change_balance(entry['user_id'], entry['ticker'], entry['amount'])
+    elif op == 'delete_user':
+        await delete_user(entry['user_id'])
+    elif op == 'delete_all_orders':
+        await delete_all_orders()
+    elif op == 'order':
+        create = create_limit_buy_order if entry['direction'] == 'BID' else create_limit_sell_order
+        order = await create(entry['ticker'], entry['qty'], entry['price'], User(id=uuid.UUID(entry['user_id'])))
+        order_ids[entry['order_id']] = order.id
+        if (order.status.name, order.filled) != (entry['status'], entry['filled']):
+            mismatches.append(f'#{entry["seq"]} order {entry["order_id"]}: {order.status.name}/{order.filled}, '
+                              f'journal {entry["status"]}/{entry["filled"]}')
+    elif op == 'cancel':
+        try:
+            await cancel_order(str(order_ids.get(entry['order_id'], entry['order_id'])), uuid.UUID(entry['user_id']))
+        except Exception as e:
+            mismatches.append(f'#{entry["seq"]} cancel {entry["order_id"]} failed: {e}')
+    else:
+        raise SystemExit(f'unknown op {op} at #{entry["seq"]}')
+
+
+async def digest() -> dict:
+    # Идентификаторы ордеров и сделок от прогона к прогону разные, поэтому сравниваем содержимое
+    async with engine.connect() as conn:
+        # Сделки одного ордера часто с одинаковым timestamp: при равенстве упорядочиваем по сравниваемым
+        # колонкам, а id - последний ключ, чтобы порядок всегда был однозначным
+        trades = (await conn.execute(
+            select(Transaction.user_from_id, Transaction.user_to_id, Transaction.instrument_ticker,
+                   Transaction.amount, Transaction.price)
+            .order_by(Transaction.timestamp, Transaction.user_from_id, Transaction.user_to_id,
+                      Transaction.instrument_ticker, Transaction.amount, Transaction.price, Transaction.id)
+        )).all()
+        users = (await conn.execute(
+            select(User.id, User.balance, User.frozen_balance).order_by(User.id)
+        )).all()
+        inventories = (await conn.execute(
+            select(UserInventory.user_id, UserInventory.instrument_ticker, UserInventory.quantity,
+                   UserInventory.frozen).order_by(UserInventory.user_id, UserInventory.instrument_ticker)
+        )).all()
+        orders = sorted((await conn.execute(
+            select(Order.user_id, Order.instrument_ticker, Order.direction, Order.price, Order.amount, Order.filled,
+                   Order.status)
+        )).all(), key=str)
+
+    def sha(rows) -> str:
+        return hashlib.sha256(json.dumps([list(r) for r in rows], default=str).encode()).hexdigest()
+
+    return {
+        'trades': len(trades),
+        'trades_sha256': sha(trades),
+        'balances_sha256': sha(list(users) + list(inventories)),
+        'orders_sha256': sha(orders),
+    }
+
+
+async def run(path: str, limit):
+    await reset()
+    order_ids, mismatches = dict(), []
+    commands = orders = 0
+    started = time.perf_counter()
+    for entry in read_journal(path, limit):
+        await apply(entry, order_ids, mismatches)
+        commands += 1
+        orders += entry['op'] == 'order'
+    elapsed = time.perf_counter() - started
+    result = await digest()
+    result.update({
+        'commands': commands,
+        'orders': orders,
+        'elapsed_s': elapsed,
+        'commands_per_s': commands / elapsed if elapsed else 0,
+        'orders_per_s': orders / elapsed if elapsed else 0,
+        'mismatches': mismatches,
+    })
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('journal')
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--limit', type=int, default=None, help='воспроизвести только первые N записей')
+    parser.add_argument('--engine', choices=['sql', 'memory'], default=crud.book.MATCHING_ENGINE)
+    parser.add_argument('--wipe', action='store_true', help='подтверждение: база одноразовая, таблицы очищаются')
+    args = parser.parse_args()
+    if not args.wipe:
+        raise SystemExit('replay truncates all exchange tables, pass --wipe to confirm the database is disposable')
+
+    # Воспроизведение не должно дописывать журнал
+    core.journal.JOURNAL.path = ''
+    crud.book.MATCHING_ENGINE = args.engine
+
+    results = []
+    for n in range(args.runs):
+        result = await run(args.journal, args.limit)
+        results.append(result)
+        print(f'run {n + 1}: {result["commands"]} commands, {result["orders"]} orders in {result["elapsed_s"]:.2f}s '
+              f'({result["orders_per_s"]:.1f} orders/s), {result["trades"]} trades, '
+              f'{len(result["mismatches"])} mismatches with journal')
+        for line in result['mismatches'][:20]:
+            print('  ', line)
+    await engine.dispose()
+
+    keys = ('trades_sha256', 'balances_sha256', 'orders_sha256')
+    if any(tuple(r[k] for k in keys) != tuple(results[0][k] for k in keys) for r in results):
+        raise SystemExit('runs diverged: trade stream or final state differs')
+    if any(r['mismatches'] for r in results):
+        raise SystemExit('replay differs from the journal')
+    print('runs are identical')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())